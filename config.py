@@ -0,0 +1,66 @@
+# config.py
+"""Общая загрузка переменных окружения и учётных данных Google для всех модулей"""
+
+import os
+from functools import lru_cache
+
+import orjson
+
+import gspread
+from dotenv import load_dotenv
+from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+ENV_FILE = 'secret.env'
+GOOGLE_SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
+
+# Пул keep-alive соединений к Google API: запросы из потоков run_in_thread не ждут TLS-рукопожатия
+GOOGLE_HTTP_POOL_SIZE = 32
+GOOGLE_HTTP_POOL_MAXSIZE = 64
+# Повторы с нарастающей паузой только при ошибках соединения.
+# 429/5xx здесь не повторяются: чтения бота повторяет run_sheets_read (паузы в event loop,
+# а не в потоке), а POST (append) по статусу повторять нельзя - задвоились бы строки
+GOOGLE_HTTP_RETRY = Retry(
+    total=3,
+    backoff_factor=0.5,
+)
+
+
+@lru_cache(maxsize=1)
+def load_env() -> None:
+    """Однократная загрузка secret.env"""
+    load_dotenv(ENV_FILE)
+
+
+def get_env(name: str) -> str:
+    """Получение обязательной переменной окружения"""
+    load_env()
+    try:
+        return os.environ[name]
+    except KeyError as e:
+        raise RuntimeError(f"Отсутствует обязательная переменная: {e}")
+
+
+@lru_cache(maxsize=1)
+def google_creds() -> dict:
+    """Учётные данные сервисного аккаунта Google (JSON разбирается один раз)"""
+    return orjson.loads(get_env('GOOGLE_CREDENTIALS'))
+
+
+@lru_cache(maxsize=1)
+def google_credentials() -> Credentials:
+    """Учётные данные сервисного аккаунта (google-auth), общие для бота и скриптов импорта"""
+    return Credentials.from_service_account_info(google_creds(), scopes=GOOGLE_SCOPES)
+
+
+@lru_cache(maxsize=1)
+def gspread_client() -> gspread.Client:
+    """Авторизованный клиент gspread (один на процесс) с общим пулом соединений"""
+    client = gspread.authorize(google_credentials())
+    client.session.mount('https://', HTTPAdapter(
+        pool_connections=GOOGLE_HTTP_POOL_SIZE,
+        pool_maxsize=GOOGLE_HTTP_POOL_MAXSIZE,
+        max_retries=GOOGLE_HTTP_RETRY,
+    ))
+    return client
@@ -1,19 +1,25 @@
-import json
 import sqlite3
-import gspread
-import os
-from main import ORDERS_SPREADSHEET_NAME, GAMMA_CLUSTER_SHEET
-from oauth2client.service_account import ServiceAccountCredentials
-from dotenv import load_dotenv
+from operator import itemgetter
+from config import gspread_client
+
+ORDERS_SPREADSHEET_NAME = "Копия Заказы МЗ 0.2"  # Таблица с листом гамма-кластера
+GAMMA_CLUSTER_SHEET = "Гамма кластер"
 
 DB_PATH = "articles.db"
 TABLE_NAME = "articles"
 
-load_dotenv("secrets.env")  # грузим GOOGLE_CREDS_JSON
+# Текстовые столбцы листа в порядке столбцов таблицы articles (без is_top_store)
+TEXT_COLUMNS = (
+    "Ключ", "Артикул", "Магазин", "Отдел", "Название",
+    "Гамма", "Номер осн. пост.", "Название осн. пост."
+)
 
 
 def prepare_db():
     conn = sqlite3.connect(DB_PATH)
+    # Настройки для массовой загрузки: без fsync на запись, временные данные в памяти
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA temp_store=MEMORY")
     cursor = conn.cursor()
     cursor.execute(f"""
         CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
@@ -28,59 +34,49 @@ def prepare_db():
             is_top_store INTEGER
         )
     """)
+    cursor.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_store_article ON {TABLE_NAME} (store_number, article_code)
+    """)
     conn.commit()
     return conn
 
 
 def get_sheet_data():
-    service_json_raw = os.getenv("GOOGLE_CREDENTIALS")
-
-    if not service_json_raw:
-        raise RuntimeError("❌ GOOGLE_CREDENTIALS не найден в secrets.env")
-
-    try:
-        service_json = json.loads(service_json_raw)
-    except json.JSONDecodeError:
-        raise RuntimeError("❌ GOOGLE_CREDENTIALS содержит неверный JSON")
-
-    scope = [
-        "https://spreadsheets.google.com/feeds",
-        "https://www.googleapis.com/auth/drive"
+    """Сырые строки листа гамма-кластера: (заголовок, строки данных) без словаря на каждую строку"""
+    # Клиент из config, как в import_supplier_data.py: скрипт не импортирует модуль бота
+    sheet = gspread_client().open(ORDERS_SPREADSHEET_NAME).worksheet(GAMMA_CLUSTER_SHEET)
+    values = sheet.get_values()
+    if not values:
+        return [], []
+    return values[0], values[1:]
+
+
+def parse_is_top(value) -> int:
+    is_top_raw = str(value).strip()
+    return int(is_top_raw) if is_top_raw.isdigit() else 0
+
+
+def import_data(headers, rows, conn):
+    # Индексы столбцов по заголовку; строки листа - списки, а не словари
+    column_index = {name: idx for idx, name in enumerate(headers)}
+    get_columns = itemgetter(*(column_index[name] for name in TEXT_COLUMNS))
+    top_idx = column_index.get("Топ в магазине")
+    width = len(headers)
+    # Хвостовые пустые ячейки API не возвращает - дополняем строку до ширины заголовка
+    prepared = [
+        (
+            *[str(value).strip() for value in get_columns(row)],
+            parse_is_top(row[top_idx]) if top_idx is not None else 0
+        )
+        for row in (r if len(r) >= width else r + [""] * (width - len(r)) for r in rows)
     ]
 
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(service_json, scope)
-    client = gspread.authorize(creds)
-
-    sheet = client.open(ORDERS_SPREADSHEET_NAME).worksheet(GAMMA_CLUSTER_SHEET)
-    return sheet.get_all_records()
-
-
-def import_data(records, conn):
+    # Очистка и загрузка одной транзакцией: читатели не видят пустую таблицу,
+    # дубликаты "Ключ" перезаписываются вместо ошибки всего импорта
+    conn.execute("BEGIN IMMEDIATE")
     conn.execute(f"DELETE FROM {TABLE_NAME}")
-    prepared = []
-
-    for row in records:
-        full_key = str(row["Ключ"]).strip()
-        article_code = str(row["Артикул"]).strip()
-        store_number = str(row["Магазин"]).strip()
-        department = str(row["Отдел"]).strip()
-        name = str(row["Название"]).strip()
-        gamma = str(row["Гамма"]).strip()
-        supplier_code = str(row["Номер осн. пост."]).strip()
-        supplier_name = str(row["Название осн. пост."]).strip()
-        try:
-            is_top_raw = str(row.get("Топ в магазине", "0")).strip()
-            is_top_store = int(is_top_raw) if is_top_raw.isdigit() else 0
-        except (ValueError, TypeError):
-            is_top_store = 0
-
-        prepared.append((
-            full_key, article_code, store_number, department,
-            name, gamma, supplier_code, supplier_name, is_top_store
-        ))
-
     conn.executemany(f"""
-        INSERT INTO {TABLE_NAME} (
+        INSERT OR REPLACE INTO {TABLE_NAME} (
             full_key, article_code, store_number, department,
             name, gamma, supplier_code, supplier_name, is_top_store
         ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
@@ -93,8 +89,8 @@ def import_data(records, conn):
 if __name__ == "__main__":
     try:
         conn = prepare_db()
-        records = get_sheet_data()
-        import_data(records, conn)
+        headers, rows = get_sheet_data()
+        import_data(headers, rows, conn)
         conn.close()
         print("✅ Импорт из Google Sheets завершён.")
     except Exception as e:
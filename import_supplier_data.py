@@ -1,26 +1,18 @@
 # import_supplier_data.py
 
 import os
-import json
 import logging
 import sqlite3
-from google.oauth2.service_account import Credentials
 import gspread
 from contextlib import contextmanager
+from operator import itemgetter
+from config import gspread_client
 
 # --- Конфигурация ---
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Загрузка переменных окружения (предполагается, что secret.env находится в той же папке)
-from dotenv import load_dotenv
-load_dotenv('secret.env')
-
-try:
-    GOOGLE_CREDS_JSON = os.environ['GOOGLE_CREDENTIALS']
-    ORDERS_SPREADSHEET_NAME = "Копия Заказы МЗ 0.2" # Имя таблицы с данными поставщиков
-except KeyError as e:
-    raise RuntimeError(f"Отсутствует обязательная переменная окружения: {e}")
+ORDERS_SPREADSHEET_NAME = "Копия Заказы МЗ 0.2" # Имя таблицы с данными поставщиков
 
 # Путь к файлу базы данных SQLite (должен быть в той же папке)
 DB_PATH = os.path.join(os.path.dirname(__file__), 'articles.db')
@@ -28,12 +20,17 @@ DB_PATH = os.path.join(os.path.dirname(__file__), 'articles.db')
 # Имя листа с гамма-кластером (нужно для определения уникальных магазинов)
 GAMMA_CLUSTER_SHEET_NAME = "Гамма кластер"
 
-# --- Инициализация Google Sheets ---
-credentials = Credentials.from_service_account_info(
-    json.loads(GOOGLE_CREDS_JSON),
-    scopes=['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
+# Максимум листов в одном запросе values.batchGet
+BATCH_GET_CHUNK_SIZE = 20
+
+# Столбцы листа поставщиков в порядке вставки в SQLite
+SUPPLIER_COLUMNS = (
+    "Номер осн. пост.", "Название осн. пост.", "Срок доставки в магазин",
+    "День выхода заказа", "День выхода заказа 2", "День выхода заказа 3",
 )
-gc = gspread.authorize(credentials)
+
+# --- Инициализация Google Sheets ---
+gc = gspread_client()
 
 # --- Контекстный менеджер для SQLite ---
 @contextmanager
@@ -57,6 +54,13 @@ def get_db_connection():
         if conn:
             conn.close()
 
+def to_int_or_zero(val) -> int:
+    """Нормализация числового поля листа поставщиков"""
+    try:
+        return int(str(val).strip())
+    except (ValueError, TypeError):
+        return 0 # Или None, если предпочитаете NULL в БД
+
 # --- Функция для получения уникальных номеров магазинов ---
 def get_unique_shops():
     """Получает список уникальных номеров магазинов из gamma_cluster."""
@@ -64,41 +68,90 @@ def get_unique_shops():
         orders_spreadsheet = gc.open(ORDERS_SPREADSHEET_NAME)
         gamma_cluster_sheet = orders_spreadsheet.worksheet(GAMMA_CLUSTER_SHEET_NAME)
         
-        # Получаем все записи из gamma_cluster
-        gamma_records = gamma_cluster_sheet.get_all_records()
+        # Загружаем только столбец "Магазин", а не все записи гамма-кластера
+        headers = gamma_cluster_sheet.row_values(1)
+        shop_column = headers.index("Магазин") + 1
+        shop_values = gamma_cluster_sheet.col_values(shop_column)[1:]
         
         # Извлекаем уникальные номера магазинов
-        unique_shops = list(set(str(record.get("Магазин", "")).strip() for record in gamma_records if record.get("Магазин")))
+        unique_shops = list(set(str(value).strip() for value in shop_values if str(value).strip()))
         logging.info(f"Найдены магазины: {unique_shops}")
         return unique_shops
     except Exception as e:
         logging.error(f"Ошибка получения списка магазинов: {e}")
         raise
 
+# --- Функция для пакетного получения листов поставщиков ---
+def fetch_supplier_records(shops: list) -> dict:
+    """
+    Получает данные листов "Даты выходов заказов {магазин}" для всех магазинов
+    через values.batchGet (один запрос на BATCH_GET_CHUNK_SIZE листов).
+    Возвращает словарь {магазин: значения листа (строка заголовка + строки данных)}.
+    """
+    orders_spreadsheet = gc.open(ORDERS_SPREADSHEET_NAME)
+    # batchGet падает целиком, если хотя бы одного листа нет, поэтому отбираем существующие
+    existing_titles = {ws.title for ws in orders_spreadsheet.worksheets()}
+    shops_with_sheet = []
+    for shop in shops:
+        if f"Даты выходов заказов {shop}" in existing_titles:
+            shops_with_sheet.append(shop)
+        else:
+            logging.warning(f"Лист 'Даты выходов заказов {shop}' не найден в таблице '{ORDERS_SPREADSHEET_NAME}'. Пропускаю.")
+
+    result = {}
+    for i in range(0, len(shops_with_sheet), BATCH_GET_CHUNK_SIZE):
+        chunk = shops_with_sheet[i:i + BATCH_GET_CHUNK_SIZE]
+        ranges = [f"'Даты выходов заказов {shop}'" for shop in chunk]
+        response = orders_spreadsheet.values_batch_get(ranges)
+        for shop, value_range in zip(chunk, response.get("valueRanges", [])):
+            result[shop] = value_range.get("values", [])
+        logging.info(f"Получены листы поставщиков для магазинов: {chunk}")
+    return result
+
 # --- Функция для импорта данных поставщиков ---
-def import_supplier_data_for_shop(shop_number: str):
+def iter_supplier_fields(values: list):
+    """
+    Значения SUPPLIER_COLUMNS по строкам листа (строки - списки, а не словари).
+    Отсутствующий на листе столбец и обрезанные API хвостовые ячейки дают "".
+    """
+    if not values:
+        return
+    headers = values[0]
+    width = len(headers)
+    column_index = {name: idx for idx, name in enumerate(headers)}
+    # Отсутствующие столбцы читаются из дополнительной пустой ячейки в конце строки
+    get_fields = itemgetter(*(column_index.get(name, width) for name in SUPPLIER_COLUMNS))
+    for row in values[1:]:
+        yield get_fields(row + [""] * (width + 1 - len(row)))
+
+
+def import_supplier_data_for_shop(shop_number: str, supplier_values: list = None):
     """
     Импортирует данные поставщиков для конкретного магазина из Google Sheets в SQLite.
     Создает таблицу, если она не существует, и очищает её перед импортом.
+    Если supplier_values переданы (пакетная загрузка), лист повторно не запрашивается.
     """
-    try:
-        orders_spreadsheet = gc.open(ORDERS_SPREADSHEET_NAME)
-        sheet_name = f"Даты выходов заказов {shop_number}"
-        supplier_sheet = orders_spreadsheet.worksheet(sheet_name)
-        logging.info(f"Обрабатываю лист: {sheet_name}")
-    except gspread.exceptions.WorksheetNotFound:
-        logging.warning(f"Лист '{sheet_name}' не найден в таблице '{ORDERS_SPREADSHEET_NAME}'. Пропускаю.")
-        return # Просто выходим, если лист не найден
-    except Exception as e:
-        logging.error(f"Ошибка открытия листа '{sheet_name}': {e}")
-        raise
+    if supplier_values is None:
+        try:
+            orders_spreadsheet = gc.open(ORDERS_SPREADSHEET_NAME)
+            sheet_name = f"Даты выходов заказов {shop_number}"
+            supplier_sheet = orders_spreadsheet.worksheet(sheet_name)
+            logging.info(f"Обрабатываю лист: {sheet_name}")
+        except gspread.exceptions.WorksheetNotFound:
+            logging.warning(f"Лист '{sheet_name}' не найден в таблице '{ORDERS_SPREADSHEET_NAME}'. Пропускаю.")
+            return # Просто выходим, если лист не найден
+        except Exception as e:
+            logging.error(f"Ошибка открытия листа '{sheet_name}': {e}")
+            raise
 
     try:
-        # Получаем все данные из листа
-        supplier_records = supplier_sheet.get_all_records()
-        logging.info(f"Получено {len(supplier_records)} записей для магазина {shop_number}")
+        if supplier_values is None:
+            # Получаем все данные из листа: сырые строки без словаря на каждую запись
+            supplier_values = supplier_sheet.get_values()
+        records_count = max(len(supplier_values) - 1, 0)
+        logging.info(f"Получено {records_count} записей для магазина {shop_number}")
 
-        if not supplier_records:
+        if not records_count:
             logging.info(f"Нет данных для импорта в магазин {shop_number}")
             return
 
@@ -120,6 +173,11 @@ def import_supplier_data_for_shop(shop_number: str):
             );
             '''
             cursor.execute(create_table_query)
+            # Индекс по номеру поставщика: бот ищет поставщика по нему на каждый заказ
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS "idx_supplier_{shop_number}" '
+                f'ON "{table_name}" ("Номер осн. пост.");'
+            )
             logging.info(f"Таблица '{table_name}' проверена/создана.")
 
             # 2. Очищаем таблицу перед импортом (TRUNCATE в SQLite это DELETE без WHERE)
@@ -129,26 +187,19 @@ def import_supplier_data_for_shop(shop_number: str):
             # 3. Подготавливаем данные для вставки
             # Фильтруем и нормализуем данные
             data_to_insert = []
-            for record in supplier_records:
+            for supplier_id, name, delivery, day_1, day_2, day_3 in iter_supplier_fields(supplier_values):
                 # Пропускаем строки, где нет номера поставщика
-                supplier_id = str(record.get("Номер осн. пост.", "")).strip()
+                supplier_id = supplier_id.strip()
                 if not supplier_id:
                     continue
 
-                # Нормализуем числовые поля
-                def to_int_or_zero(val):
-                    try:
-                        return int(str(val).strip())
-                    except (ValueError, TypeError):
-                        return 0 # Или None, если предпочитаете NULL в БД
-
                 data_to_insert.append((
                     supplier_id,
-                    str(record.get("Название осн. пост.", "")).strip(),
-                    to_int_or_zero(record.get("Срок доставки в магазин", 0)),
-                    to_int_or_zero(record.get("День выхода заказа", 0)),
-                    to_int_or_zero(record.get("День выхода заказа 2", 0)),
-                    to_int_or_zero(record.get("День выхода заказа 3", 0))
+                    name.strip(),
+                    to_int_or_zero(delivery),
+                    to_int_or_zero(day_1),
+                    to_int_or_zero(day_2),
+                    to_int_or_zero(day_3)
                 ))
 
             if not data_to_insert:
@@ -181,9 +232,10 @@ def main():
         shops = get_unique_shops()
         logging.info(f"Начинаю импорт для {len(shops)} магазинов.")
         
-        for shop in shops:
+        records_by_shop = fetch_supplier_records(shops)
+        for shop, supplier_values in records_by_shop.items():
             try:
-                import_supplier_data_for_shop(shop)
+                import_supplier_data_for_shop(shop, supplier_values)
             except Exception as e:
                 # Логируем ошибку, но продолжаем импорт для других магазинов
                 logging.error(f"Не удалось импортировать данные для магазина {shop}: {e}")
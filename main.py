@@ -1,11 +1,10 @@
 import os
-import json
+import orjson
 import pickle
 import io 
 import re
 import gc
 import asyncio
-import inspect
 import logging
 import traceback
 import time
@@ -16,28 +15,35 @@ import psutil
 import sqlite3
 import gspread.utils
 import uuid
+import random
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager, closing, suppress
-from aiogram.exceptions import TelegramBadRequest
+from functools import lru_cache
+from operator import itemgetter
 from aiogram.utils.markdown import markdown_decoration
-from typing import Dict, Any, List, Optional, Tuple
+from typing import Dict, Any, List, Mapping, Optional, Tuple
+from types import MappingProxyType
 from datetime import datetime, timedelta, date
 from aiogram import Bot, Dispatcher, types, F, Router
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.enums import ParseMode
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
 from aiogram.types import ReplyKeyboardRemove, File, BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.exceptions import TelegramForbiddenError
-from aiogram.filters import Command
-from google.oauth2.service_account import Credentials
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.filters import Command, StateFilter
 import gspread
 from gspread.exceptions import APIError, SpreadsheetNotFound
-from cachetools import LRUCache
+from cachetools import LRUCache, TLRUCache
 from rating_module import process_csv_and_update_ratings
 from pathlib import Path
 from import_holidays import import_holidays_from_csv
+from config import get_env, google_creds, google_credentials, gspread_client
+from rate_limit import AsyncTokenBucket
+from supplier_schedule import parse_supplier_data, calculate_delivery_date
 
 
 
@@ -67,6 +73,26 @@ def get_db_connection():
             conn.close()
 
 
+_read_connections = threading.local()
+
+
+def get_read_connection() -> sqlite3.Connection:
+    """
+    Постоянное (на поток) подключение к SQLite только для чтения справочников.
+    Поиск товаров выполняется на каждый запрос пользователя - без повторных connect()/close().
+    """
+    conn = getattr(_read_connections, "conn", None)
+    if conn is None:
+        if not os.path.exists(DB_PATH):
+            logging.critical(f"❌ Файл базы данных не найден: {DB_PATH}")
+            raise FileNotFoundError(f"Файл базы данных не найден: {DB_PATH}")
+        conn = sqlite3.connect(DB_PATH)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only = ON")
+        _read_connections.conn = conn
+    return conn
+
+
 async def global_error_handler(event: types.ErrorEvent, bot: Bot):
     """Централизованный обработчик всех необработанных исключений"""
     exception = event.exception
@@ -94,30 +120,22 @@ async def global_error_handler(event: types.ErrorEvent, bot: Bot):
     
     # Логируем в Google Sheets
     if user_id:
-        try:
-            logs_sheet.append_row([
-                datetime.now().strftime("%d.%m.%Y %H:%M"),
-                str(user_id),
-                "CRITICAL_ERROR",
-                f"{error_type}: {error_message[:200]}"
-            ])
-        except Exception as log_ex:
-            logging.error(f"Ошибка при логировании: {str(log_ex)}")
+        enqueue_log_row([
+            now_minute_str(),
+            str(user_id),
+            "CRITICAL_ERROR",
+            f"{error_type}: {error_message[:200]}"
+        ])
     
     # Уведомляем администраторов
-    for admin_id in ADMINS:
-        try:
-            await bot.send_message(
-                admin_id,
-                f"🚨 <b>Критическая ошибка</b>\n"
-                f"• Пользователь: {user_id}\n"
-                f"• Тип: {error_type}\n"
-                f"• Сообщение: {error_message}\n\n"
-                f"<code>{traceback_str[:3500]}</code>",
-                parse_mode=ParseMode.HTML
-            )
-        except Exception:
-            pass
+    await notify_admins(
+        f"🚨 <b>Критическая ошибка</b>\n"
+        f"• Пользователь: {user_id}\n"
+        f"• Тип: {error_type}\n"
+        f"• Сообщение: {error_message}\n\n"
+        f"<code>{traceback_str[:3500]}</code>",
+        parse_mode=ParseMode.HTML
+    )
     
     # Отправляем сообщение пользователю
     if user_id:
@@ -275,21 +293,54 @@ reminder_running = True
 CACHE_TTL = 43200  # 12 часов
 cache = LRUCache(maxsize=500)
 
-# Загрузка переменных окружения
-from dotenv import load_dotenv
-load_dotenv('secret.env')
 
-# Проверка обязательных переменных
-try:
-    BOT_TOKEN = os.environ['BOT_TOKEN']
-    GOOGLE_CREDS_JSON = os.environ['GOOGLE_CREDENTIALS']
-except KeyError as e:
-    raise RuntimeError(f"Отсутствует обязательная переменная: {e}")
+
+def jittered_ttu(_key, _value, now: float) -> float:
+    """Срок жизни записи CACHE_TTL ±10%: записи, добавленные одновременно (например, после
+    перезагрузки кэша), истекают вразброс, а не все разом"""
+    return now + CACHE_TTL * random.uniform(0.9, 1.1)
+
+
+# Товары из SQLite по (артикул, магазин): повторные запросы одного артикула без обращения к БД
+product_cache = TLRUCache(maxsize=5000, ttu=jittered_ttu)
+
+# Поставщики магазинов из SQLite: {магазин: {номер поставщика: запись}}
+supplier_cache = TLRUCache(maxsize=200, ttu=jittered_ttu)
+
+# Очередь записи на лист логов: пачки до LOG_BATCH_SIZE строк, не реже раза в LOG_FLUSH_INTERVAL секунд
+LOG_QUEUE: asyncio.Queue = asyncio.Queue(maxsize=10000)
+LOG_BATCH_SIZE = 100
+LOG_FLUSH_INTERVAL = 5
+
+# Очередь статистики действий пользователей (лист статистики), пишется тем же способом
+STATS_QUEUE: asyncio.Queue = asyncio.Queue(maxsize=10000)
+
+# Соединения с Telegram API
+TELEGRAM_CONNECTION_LIMIT = 100
+TELEGRAM_KEEPALIVE_TIMEOUT = 60  # секунд
+
+# Массовые отправки (рассылки, задачи, напоминания): общий лимит сообщений в секунду
+# на все рассылки сразу, лимит Telegram - 30/сек
+TELEGRAM_SEND_RATE = 25
+
+# Пул потоков для блокирующих вызовов (gspread, SQLite, обработка CSV) через run_in_thread
+BLOCKING_IO_WORKERS = 16
+
+# Повторы чтений Google Sheets при 429/5xx: попыток всего и базовая пауза (с), далее x2
+SHEETS_READ_ATTEMPTS = 4
+SHEETS_RETRY_BASE_DELAY = 2
+
+# Прогрев кэша поставщиков при старте: одновременно загружаемых таблиц магазинов
+SUPPLIER_PRELOAD_CONCURRENCY = 4
+
+# Загрузка переменных окружения и проверка обязательных переменных
+BOT_TOKEN = get_env('BOT_TOKEN')
 
 # Конфигурация Google Sheets
-GOOGLE_CREDS = json.loads(GOOGLE_CREDS_JSON)
+GOOGLE_CREDS = google_creds()
 SPREADSHEET_NAME = "ShopBotData"
 STATSS_SHEET_NAME = "Статистика_Пользователей"
+STATS_EVENT_TYPE_COL = 9  # столбец I "Тип события" (см. log_user_activity)
 ORDERS_SPREADSHEET_NAME = "Копия Заказы МЗ 0.2"
 USERS_SHEET_NAME = "Пользователи"
 GAMMA_CLUSTER_SHEET = "Гамма кластер"
@@ -298,14 +349,40 @@ LOGS_SHEET = "Логи"
 MANAGERS_SHEET_NAME = "МЗ"
 
 # ===================== ИНИЦИАЛИЗАЦИЯ =====================
-credentials = Credentials.from_service_account_info(
-    GOOGLE_CREDS,
-    scopes=['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
+credentials = google_credentials()
+client = gspread_client()
+
+def telegram_json_dumps(obj) -> str:
+    """Сериализация JSON-полей запросов Telegram через orjson. BaseSession.prepare_value вызывает её
+    для словарей/списков (reply_markup, entities, media) и скалярных полей; даты и Enum к этому
+    моменту уже преобразованы aiogram"""
+    return orjson.dumps(obj).decode()
+
+
+class TelegramSession(AiohttpSession):
+    """
+    AiohttpSession с настройкой пула соединений: в aiogram 3.4 конструктор не принимает limit,
+    параметры TCPConnector задаются только через _connector_init (из него создаётся коннектор)
+    """
+
+    def __init__(self, limit: int, keepalive_timeout: float, **kwargs):
+        super().__init__(**kwargs)
+        self._connector_init.update(limit=limit, keepalive_timeout=keepalive_timeout)
+
+
+# Пул соединений с Telegram: держим соединения открытыми между пачками отправок
+# Ответы Telegram (в т.ч. входящие обновления getUpdates) разбираются через orjson,
+# им же сериализуются вложенные JSON-поля запросов (reply_markup, entities и т.п.)
+telegram_session = TelegramSession(
+    limit=TELEGRAM_CONNECTION_LIMIT,
+    keepalive_timeout=TELEGRAM_KEEPALIVE_TIMEOUT,
+    json_loads=orjson.loads,
+    json_dumps=telegram_json_dumps,
 )
-client = gspread.authorize(credentials)
 
 bot = Bot(
     token=BOT_TOKEN,
+    session=telegram_session,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
 
@@ -320,10 +397,10 @@ try:
     logs_sheet = main_spreadsheet.worksheet(LOGS_SHEET)
     orders_spreadsheet = client.open(ORDERS_SPREADSHEET_NAME)
     gamma_cluster_sheet = orders_spreadsheet.worksheet(GAMMA_CLUSTER_SHEET)
-    print("✅ Google Sheets успешно инициализированы")
-except Exception as e:
-    print(f"❌ Ошибка инициализации Google Sheets: {str(e)}")
-    exit()
+    logging.info("✅ Google Sheets успешно инициализированы")
+except Exception:
+    logging.exception("❌ Ошибка инициализации Google Sheets")
+    raise
 
 
 # ===================== СОСТОЯНИЯ FSM =====================
@@ -414,147 +491,316 @@ def create_keyboard(buttons: List[str], sizes: tuple, resize=True, one_time=Fals
         one_time_keyboard=one_time
     )
 
+# Статичные клавиатуры собираются один раз при импорте и переиспользуются всеми обработчиками
+MAIN_MENU_BUTTONS = ["📋 Запрос информации", "🛒 Заказ под клиента", "🖼️ Экспо", "📞 Обратная связь",]
+MAIN_MENU_KB = create_keyboard(MAIN_MENU_BUTTONS, (2, 2, 1))
+ADMIN_MAIN_MENU_KB = create_keyboard(MAIN_MENU_BUTTONS + ["🛠 Админ-панель"], (2, 2, 1))
+ARTICLE_INPUT_KB = create_keyboard(["❌ Отмена"], (1,))
+SHOP_SELECTION_KB = create_keyboard(["Использовать мой магазин", "Выбрать другой", "❌ Отмена"], (2, 1))
+CONFIRM_KB = create_keyboard(["✅ Подтвердить", "✏️ Исправить количество", "❌ Отмена"], (2, 1))
+ADMIN_PANEL_KB = create_keyboard(
+    ["📊 Статистика", "📢 Рассылка", "🔄 Обновить кэш", "🔧 Сервисный режим", "📊 Дамп памяти", "📝 Управление задачами", "🔙 Главное меню"],
+    (3, 2, 2)
+)
+SERVICE_MODE_KB = create_keyboard(["🟢 Включить сервисный режим", "🔴 Выключить сервисный режим", "🔙 Назад"], (2, 1))
+CANCEL_KB = create_keyboard(["❌ Отмена"], (1,))
+BROADCAST_TARGET_KB = create_keyboard(["Всем пользователям", "По магазинам", "По отделам", "Вручную", "❌ Отмена"], (2, 2, 1))
+BROADCAST_CONFIRMATION_KB = create_keyboard(["✅ Подтвердить рассылку", "❌ Отмена"], (2,))
+TASKS_ADMIN_KB = create_keyboard(
+    ["➕ Добавить задачу", "🗑️ Удалить задачу", "📤 Отправить список", "📊 Статистика выполнения", "🔙 Назад"],
+    (2, 2, 1)
+)
+TASK_SEND_ACTION_KB = create_keyboard(["Отправить все", "Выбрать задачи", "🔙 Назад"], (2, 1))
+TASK_AUDIENCE_KB = create_keyboard(["Всем пользователям", "По должности", "Вручную", "🔙 Назад"], (2, 2))
+TASK_SEND_CONFIRM_KB = create_keyboard(["📤 Подтвердить отправку", "❌ Отмена"], (2,))
+TASK_STATS_KB = create_keyboard(["Детали по задаче", "🔙 Назад"], (1,))
+EXPO_ACTION_KB = create_keyboard(["➕ Поставить на Экспо", "➖ Снять с Экспо", "❌ Отмена"], (2, 1))
+INFO_ACTION_KB = create_keyboard(["🛒 Заказать этот товар", "🔄 Повторить ввод артикула", "🏠 В главное меню"], (3,))
+
+# Шаблоны сообщений о товаре/заказе (p - словарь get_product_info)
+ORDER_PRODUCT_TMPL = (
+    "🏪 Магазин: {shop}\n"
+    "📦 Артикул: {p[Артикул]}\n"
+    "🏷️ Название: {p[Название]}\n"
+    "🏭 Поставщик: {p[Поставщик]}\n"
+    "📅 Дата заказа: {p[Дата заказа]}\n"
+    "🚚 Дата поставки: {p[Дата поставки]}\n"
+)
+INFO_PRODUCT_TMPL = (
+    "🔍 Информация о товаре:\n"
+    "🏪 Магазин: {shop}\n"
+    "📦 Артикул: {p[Артикул]}\n"
+    "🏷️ Название: {p[Название]}\n"
+    "🔢 Отдел: {p[Отдел]}\n"
+    "📅 Ближайшая дата заказа: {p[Дата заказа]}\n"
+    "🚚 Ожидаемая дата поставки: {p[Дата поставки]}\n"
+    "🏭 Поставщик: {p[Поставщик]}"
+)
+ORDER_CONFIRM_TMPL = (
+    "🔎 Проверьте данные заказа:\n"
+    "🏪 Магазин: {selected_shop}\n"
+    "📦 Артикул: {article}\n"
+    "🏷️ Название: {product_name}\n"
+    "🏭 Поставщик: {supplier_name}\n"
+    "📅 Дата заказа: {order_date}\n"
+    "🚚 Дата поставки: {delivery_date}\n"
+    "🔢 Кол-во: {quantity}\n"
+    "📝 Причина: {order_reason}\n"
+)
+
+
+class TemplateData(dict):
+    """Данные для format_map: отсутствующие поля выводятся как N/A"""
+    def __missing__(self, key):
+        return 'N/A'
+
+
 def main_menu_keyboard(user_id: int = None) -> types.ReplyKeyboardMarkup:
     """Главное меню с учетом прав"""
-    buttons = ["📋 Запрос информации", "🛒 Заказ под клиента", "🖼️ Экспо", "📞 Обратная связь",]
     if user_id and user_id in ADMINS:
-        buttons.append("🛠 Админ-панель")
-    return create_keyboard(buttons, (2, 2, 1))
+        return ADMIN_MAIN_MENU_KB
+    return MAIN_MENU_KB
 
 def article_input_keyboard() -> types.ReplyKeyboardMarkup:
-    return create_keyboard(
-        [ "❌ Отмена"],
-        (1)
-    )
+    return ARTICLE_INPUT_KB
 
 def shop_selection_keyboard() -> types.ReplyKeyboardMarkup:
-    return create_keyboard(
-        ["Использовать мой магазин", "Выбрать другой", "❌ Отмена"],
-        (2, 1)
-    )
+    return SHOP_SELECTION_KB
 
 def confirm_keyboard() -> types.ReplyKeyboardMarkup:
-    return create_keyboard(
-        ["✅ Подтвердить", "✏️ Исправить количество", "❌ Отмена"],
-        (2, 1)
-    )
+    return CONFIRM_KB
 
 def admin_panel_keyboard() -> types.ReplyKeyboardMarkup:
-    return create_keyboard(
-        ["📊 Статистика", "📢 Рассылка", "🔄 Обновить кэш", "🔧 Сервисный режим", "📊 Дамп памяти", "📝 Управление задачами", "🔙 Главное меню"],
-        (3, 2, 2)
-    )
+    return ADMIN_PANEL_KB
 
 def service_mode_keyboard() -> types.ReplyKeyboardMarkup:
-    return create_keyboard(
-        ["🟢 Включить сервисный режим", "🔴 Выключить сервисный режим", "🔙 Назад"],
-        (2, 1)
-    )
+    return SERVICE_MODE_KB
 
 def cancel_keyboard() -> types.ReplyKeyboardMarkup:
-    return create_keyboard(["❌ Отмена"], (1,))
+    return CANCEL_KB
 
 
 def broadcast_target_keyboard():
-    return create_keyboard(
-        ["Всем пользователям", "По магазинам", "По отделам", "Вручную", "❌ Отмена"],
-        (2, 2, 1)
-    )
+    return BROADCAST_TARGET_KB
 
 def broadcast_confirmation_keyboard():
-    return create_keyboard(
-        ["✅ Подтвердить рассылку", "❌ Отмена"],
-        (2,)
-    )
+    return BROADCAST_CONFIRMATION_KB
 
 def tasks_admin_keyboard() -> types.ReplyKeyboardMarkup:
-    return create_keyboard(
-        ["➕ Добавить задачу", "🗑️ Удалить задачу", "📤 Отправить список", "📊 Статистика выполнения", "🔙 Назад"],
-        (2, 2, 1)
-    )
+    return TASKS_ADMIN_KB
 
+@lru_cache(maxsize=256)
 def get_task_keyboard(task_id: str) -> types.InlineKeyboardMarkup:
-    builder = InlineKeyboardBuilder()
-    builder.button(
-        text="✅ Выполнено", 
-        callback_data=f"task_done:{task_id}"
-    )
-    return builder.as_markup()
+    """Кнопка отметки задачи (одна разметка на задачу для всех получателей)"""
+    return types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text="✅ Выполнено", callback_data=f"task_done:{task_id}")]
+    ])
+
+
+TASK_ALREADY_DONE_KB = types.InlineKeyboardMarkup(inline_keyboard=[
+    [types.InlineKeyboardButton(text="✔️ Выполнено", callback_data="task_already_done")]
+])
+
+
+# Сопоставление кнопки быстрого выбора с номером магазина
+QUICK_SHOP_MAPPING = {
+    "🏪 Магазин 7": "7",
+    "🏪 Магазин 14": "14",
+    "🏪 Магазин 69": "69",
+    "🏪 Магазин 94": "94"
+}
+QUICK_SHOP_SELECTION_KB = create_keyboard(list(QUICK_SHOP_MAPPING) + ["❌ Отмена"], (2, 2, 1))
 
 
 def quick_shop_selection_keyboard() -> types.ReplyKeyboardMarkup:
     """Клавиатура для быстрого выбора из 3 магазинов."""
-    builder = ReplyKeyboardBuilder()
-    builder.button(text="🏪 Магазин 7")
-    builder.button(text="🏪 Магазин 14")
-    builder.button(text="🏪 Магазин 69")
-    builder.button(text="🏪 Магазин 94")
-    builder.button(text="❌ Отмена") # Добавим кнопку отмены
-    builder.adjust(2, 2, 1) 
-    return builder.as_markup(resize_keyboard=True)
+    return QUICK_SHOP_SELECTION_KB
 
 
 # ===================== СЕРВИСНЫЕ ФУНКЦИИ =====================
-async def notify_admins(message: str) -> None:
-    """Уведомление администраторов"""
-    for admin_id in ADMINS:
-        with suppress(TelegramForbiddenError):
-            await bot.send_message(admin_id, message)
+# Объекты листов по (id таблицы, название): worksheet() каждый раз запрашивает метаданные таблицы
+worksheets_cache: Dict[Tuple[str, str], gspread.Worksheet] = {}
+
+
+def get_worksheet(spreadsheet: gspread.Spreadsheet, title: str) -> gspread.Worksheet:
+    """Лист таблицы с кэшированием объекта листа"""
+    key = (spreadsheet.id, title)
+    worksheet = worksheets_cache.get(key)
+    if worksheet is None:
+        worksheet = spreadsheet.worksheet(title)
+        worksheets_cache[key] = worksheet
+    return worksheet
+
+async def notify_admins(message: str, **kwargs) -> None:
+    """Уведомление администраторов (параллельно; kwargs передаются в send_message)"""
+    async def send_one(admin_id: int) -> None:
+        try:
+            await bot.send_message(admin_id, message, **kwargs)
+        except TelegramForbiddenError:
+            pass
+        except Exception as e:
+            logging.error(f"Не удалось уведомить администратора {admin_id}: {e}")
+
+    await asyncio.gather(*(send_one(admin_id) for admin_id in ADMINS))
 
 async def toggle_service_mode(enable: bool) -> None:
     """Включение/выключение сервисного режима"""
-    global SERVICE_MODE
-    SERVICE_MODE = enable
+    set_service_mode(enable)
     status = "ВКЛЮЧЕН" if enable else "ВЫКЛЮЧЕН"
     await notify_admins(f"🛠 Сервисный режим {status}")
 
-async def get_user_data(user_id: str) -> Optional[Dict[str, Any]]:
-    """Получение данных пользователя с улучшенной обработкой ошибок"""
-    try:
-        cache_key = f"user_{user_id}"
-        if cache_key in cache:
-            user_data = cache[cache_key]
-            # Проверяем наличие обязательных полей
-            if all(key in user_data for key in ['shop', 'name', 'position']):
-                return user_data
-            else:
-                # Если данные неполные, запрашиваем заново
-                cache.pop(cache_key, None)
-        
-        # Загрузка данных из Google Sheets
-        users_records = pickle.loads(cache.get("users_data", b""))
+def _user_view(user: Dict[str, Any]) -> Mapping[str, Any]:
+    """Неизменяемое представление строки пользователя"""
+    return MappingProxyType({
+        'shop': user.get("Номер магазина", "") or "Не указан",
+        'name': user.get("Имя", "") or "Не указано",
+        'surname': user.get("Фамилия", "") or "Не указано",
+        'position': user.get("Должность", "") or "Не указана"
+    })
+
+
+def cache_users_records(users_records: List[Dict[str, Any]]) -> None:
+    """Сохранение пользователей в кэш вместе с индексом по ID"""
+    cache["users_data"] = pickle.dumps(users_records)
+    # Единый индекс пользователей: неизменяемые представления строк таблицы
+    cache["users_by_id"] = {
+        str(user.get("ID пользователя", "")).strip(): _user_view(user)
+        for user in users_records
+        if user.get("ID пользователя")
+    }
+
+
+def cache_user_record(user: Dict[str, Any]) -> None:
+    """Добавление одного пользователя в кэш (после регистрации) без перезагрузки листа"""
+    users_by_id = cache.get("users_by_id")
+    if users_by_id is None:
+        # Индекса нет (кэш сброшен/вытеснен): get_user_data загрузит лист целиком, уже с новой строкой.
+        # Строить индекс из одного пользователя нельзя - остальные стали бы "незарегистрированными"
+        return
+    users_by_id[str(user["ID пользователя"]).strip()] = _user_view(user)
+    if "users_data" in cache:
+        users_records = pickle.loads(cache["users_data"])
+        users_records.append(user)
+        cache["users_data"] = pickle.dumps(users_records)
+
+
+async def get_users_index() -> Optional[Dict[str, Mapping[str, Any]]]:
+    """Индекс пользователей {ID: данные}; при его отсутствии - загрузка из Google Sheets"""
+    users_by_id = cache.get("users_by_id")
+    if users_by_id is None:
+        users_records = pickle.loads(cache.get("users_data", b"")) if "users_data" in cache else []
         if not users_records:
-            users_records = users_sheet.get_all_records()
-            cache["users_data"] = pickle.dumps(users_records)
-        
-        for user in users_records:
-            if str(user.get("ID пользователя", "")).strip() == str(user_id).strip():
-                user_data = {
-                    'shop': user.get("Номер магазина", "") or "Не указан",
-                    'name': user.get("Имя", "") or "Не указано",
-                    'surname': user.get("Фамилия", "") or "Не указано",
-                    'position': user.get("Должность", "") or "Не указана"
-                }
-                cache[cache_key] = user_data
-                return user_data
-        
+            try:
+                users_records = await run_sheets_read(users_sheet.get_all_records)
+            except (gspread.exceptions.GSpreadException, OSError) as e:
+                logging.error(f"Ошибка получения данных пользователя: {str(e)}")
+                return None
+        cache_users_records(users_records)
+        users_by_id = cache["users_by_id"]
+    return users_by_id
+
+
+async def get_user_data(user_id: str) -> Optional[Mapping[str, Any]]:
+    """Получение данных пользователя с улучшенной обработкой ошибок"""
+    users_by_id = await get_users_index()
+    if users_by_id is None:
         return None
+    return users_by_id.get(str(user_id).strip())
+
+
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+def json_dumps(obj) -> str:
+    """Сериализация в JSON-строку через orjson (даты/прочие типы - через str, как json.dumps(default=str))"""
+    return orjson.dumps(obj, default=str, option=ORJSON_OPTIONS).decode()
+
+
+_minute_stamp = [0, ""]
+
+
+def now_minute_str() -> str:
+    """Текущее время в формате "дд.мм.гггг чч:мм" (строка пересчитывается раз в минуту)"""
+    minute = int(time.time() // 60)
+    if minute != _minute_stamp[0]:
+        _minute_stamp[0] = minute
+        _minute_stamp[1] = datetime.fromtimestamp(minute * 60).strftime("%d.%m.%Y %H:%M")
+    return _minute_stamp[1]
+
+
+def enqueue_log_row(row: list) -> None:
+    """Постановка строки в очередь записи на лист логов (без ожидания Google Sheets)"""
+    try:
+        LOG_QUEUE.put_nowait(row)
+    except asyncio.QueueFull:
+        logging.error(f"Очередь логов переполнена, запись потеряна: {row}")
+
+
+async def flush_log_rows(rows: list) -> None:
+    """Запись пачки строк на лист логов одним запросом"""
+    try:
+        await run_in_thread(logs_sheet.append_rows, rows, value_input_option='RAW')
     except Exception as e:
-        logging.error(f"Ошибка получения данных пользователя: {str(e)}")
-        return None
+        logging.error(f"Ошибка записи логов ({len(rows)} строк): {str(e)}")
 
 
-async def log_error(user_id: str, error: str) -> None:
-    """Логирование ошибок"""
+def enqueue_stats_row(row: list) -> None:
+    """Постановка строки в очередь записи на лист статистики"""
     try:
-        logs_sheet.append_row([
-            datetime.now().strftime("%d.%m.%Y %H:%M"),
-            user_id,
-            "ERROR",
-            error
-        ])
+        STATS_QUEUE.put_nowait(row)
+    except asyncio.QueueFull:
+        logging.error(f"Очередь статистики переполнена, запись потеряна: {row}")
+
+
+async def flush_stats_rows(rows: list) -> None:
+    """Запись пачки строк на лист статистики одним запросом"""
+    try:
+        stats_sheet = await run_in_thread(get_worksheet, main_spreadsheet, STATSS_SHEET_NAME)
+        await run_in_thread(stats_sheet.append_rows, rows, value_input_option='RAW')
     except Exception as e:
-        logging.error(f"Ошибка логирования: {str(e)}")
+        logging.error(f"Ошибка записи статистики ({len(rows)} строк): {str(e)}")
+
+
+async def log_flusher(queue: asyncio.Queue = LOG_QUEUE, flush=flush_log_rows) -> None:
+    """Фоновая запись строк очереди в Google Sheets пачками (по умолчанию - логи)"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = []
+        try:
+            # Ждём первую запись, затем копим пачку до LOG_BATCH_SIZE строк или LOG_FLUSH_INTERVAL секунд
+            batch.append(await queue.get())
+            deadline = loop.time() + LOG_FLUSH_INTERVAL
+            while len(batch) < LOG_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                batch.append(await asyncio.wait_for(queue.get(), timeout=timeout))
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if batch:
+                await flush(batch)
+            break
+        await flush(batch)
+
+
+async def drain_log_queue(queue: asyncio.Queue = LOG_QUEUE, flush=flush_log_rows) -> None:
+    """Запись оставшихся в очереди строк (при завершении работы)"""
+    batch = []
+    while not queue.empty():
+        batch.append(queue.get_nowait())
+    if batch:
+        await flush(batch)
+
+
+async def log_error(user_id: str, error: str) -> None:
+    """Логирование ошибок"""
+    enqueue_log_row([
+        now_minute_str(),
+        user_id,
+        "ERROR",
+        error
+    ])
 
 async def log_user_activity(user_id: str, command: str, event_type: str = "command") -> None:
     """Логирование действий пользователя"""
@@ -563,9 +809,10 @@ async def log_user_activity(user_id: str, command: str, event_type: str = "comma
         if not user_data:
             return
             
-        record = [
-            datetime.now().strftime("%d.%m.%Y"),
-            datetime.now().strftime("%H:%M:%S"),
+        now = datetime.now()
+        enqueue_stats_row([
+            now.strftime("%d.%m.%Y"),
+            now.strftime("%H:%M:%S"),
             str(user_id),
             user_data.get('name', ''),
             user_data.get('surname', ''),
@@ -573,10 +820,7 @@ async def log_user_activity(user_id: str, command: str, event_type: str = "comma
             user_data.get('shop', ''),
             command,
             event_type
-        ]
-        
-        stats_sheet = main_spreadsheet.worksheet(STATSS_SHEET_NAME)
-        stats_sheet.append_row(record)
+        ])
     except Exception as e:
         logging.error(f"Ошибка логирования активности: {str(e)}")
 
@@ -714,9 +958,29 @@ def normalize_task_row(task_id: str, row: dict) -> dict:
     }
 
 
+# Столбцы листа задач, которые читает load_tasks (ищутся по заголовку, порядок на листе не важен)
+TASK_SHEET_COLUMNS = (
+    "ID задачи", "Текст", "Ссылка", "Дедлайн",
+    "ID создателя", "Инициалы", "Создано",
+    "Назначена", "Статусы",
+)
+
+
 def get_tasks_sheet():
     """Возвращает лист с задачами"""
-    return main_spreadsheet.worksheet(TASKS_SHEET_NAME)
+    return get_worksheet(main_spreadsheet, TASKS_SHEET_NAME)
+
+
+def find_task_row(sheet, task_id: str) -> Optional[int]:
+    """
+    Номер строки задачи по её ID.
+    Загружает только столбец A (ID задач) вместо всего листа, как делает sheet.find.
+    """
+    task_ids = sheet.col_values(1)
+    try:
+        return task_ids.index(str(task_id)) + 1
+    except ValueError:
+        return None
 
 
 def format_task_message(task_id: str, task: dict) -> str:
@@ -798,17 +1062,17 @@ async def save_task(
     deadline: str = None
 ):
     """Сохранение задачи в Google Sheets"""
-    sheet = get_tasks_sheet()
-    sheet.append_row([
+    sheet = await run_in_thread(get_tasks_sheet)
+    await run_in_thread(sheet.append_row, [
         task_id,
         text,
         link,
         deadline,
         creator_id,
         creator_initials,
-        datetime.now().strftime("%d.%m.%Y %H:%M"),
+        now_minute_str(),
         "",
-        json.dumps({"user_ids": []})  # Пустой список для статусов
+        json_dumps({"user_ids": []})  # Пустой список для статусов
     ])
 
 
@@ -819,23 +1083,32 @@ async def load_tasks() -> Dict[str, Dict[str, Any]]:
     Возвращает словарь: {task_id: {task_data}}
     task_data включает: text, link, deadline, creator_initials, creator_id, assigned_to, completed_by
     """
-    sheet = get_tasks_sheet()
+    sheet = await run_in_thread(get_tasks_sheet)
     tasks = {}
     try:
-        expected_headers = [
-        "ID задачи", "Текст", "Ссылка", "Дедлайн",
-        "ID создателя", "Инициалы", "Создано",
-        "Назначена", "Статусы"]
-        records = sheet.get_all_records(expected_headers=expected_headers)
+        # Строки листа - списки значений (без словаря на строку); столбцы TASK_SHEET_COLUMNS
+        # находятся по строке заголовка
+        values = await run_sheets_read(sheet.get_values)
+        headers = values[0] if values else []
+        column_index = {name: idx for idx, name in enumerate(headers)}
+        missing_columns = [name for name in TASK_SHEET_COLUMNS if name not in column_index]
+        if missing_columns:
+            raise gspread.exceptions.GSpreadException(f"На листе задач нет столбцов: {missing_columns}")
+        get_task_fields = itemgetter(*(column_index[name] for name in TASK_SHEET_COLUMNS))
+        width = len(headers)
+        records = values[1:]
         logging.info(f"Загружено {len(records)} строк из Google Sheets для задач.")
         for row in records:
-            task_id = str(row.get("ID задачи", "")).strip()
+            # Хвостовые пустые ячейки API не возвращает - дополняем строку до ширины заголовка
+            (task_id, text, link, deadline, creator_id, creator_initials, _created,
+             assigned_raw, statuses_raw) = get_task_fields(row + [""] * (width - len(row)))
+            task_id = task_id.strip()
             if not task_id:
                 continue # Пропускаем строки без ID
             
             # Обработка назначенных пользователей
-            assigned_raw = str(row.get("Назначена", "")).strip()
-            logging.debug(f"Задача {task_id}: Сырое значение 'Назначена' = '{assigned_raw}' (тип: {type(assigned_raw)})")
+            assigned_raw = assigned_raw.strip()
+            logging.debug("Задача %s: Сырое значение 'Назначена' = '%s'", task_id, assigned_raw)
             if assigned_raw:
                 # Разбиваем строку, очищаем и фильтруем ID
                 assigned_user_ids = [
@@ -843,18 +1116,18 @@ async def load_tasks() -> Dict[str, Dict[str, Any]]:
                     (uid.strip() for uid in assigned_raw.split(","))
                     if uid_str.isdigit()
                 ]
-                logging.debug(f"Задача {task_id}: Обработанные ID 'Назначена' = {assigned_user_ids} (типы: {[type(uid) for uid in assigned_user_ids]})")
+                logging.debug("Задача %s: Обработанные ID 'Назначена' = %s", task_id, assigned_user_ids)
                 
             else:
                 assigned_user_ids = []
 
             # --- Исправлено и Улучшено: Обработка выполненных пользователей с поддержкой старого формата ---
             completed_user_ids = []
-            statuses_raw = str(row.get("Статусы", "{}")).strip()
-            logging.debug(f"Задача {task_id}: Сырой статус = '{statuses_raw}'")
+            statuses_raw = statuses_raw.strip()
+            logging.debug("Задача %s: Сырой статус = '%s'", task_id, statuses_raw)
             if statuses_raw:
                 try:
-                    statuses_data = json.loads(statuses_raw)
+                    statuses_data = orjson.loads(statuses_raw)
                     # logging.debug(f"Задача {task_id}: Распарсенный статус = {statuses_data} (тип: {type(statuses_data)})")
                     if isinstance(statuses_data, dict):
                         # Новый формат: {"completed_by": [...]}
@@ -877,23 +1150,23 @@ async def load_tasks() -> Dict[str, Dict[str, Any]]:
                         # Если statuses_data не словарь (например, пустой список или что-то еще)
                         logging.warning(f"Неверная структура 'Статусы' для задачи {task_id} (не словарь): {statuses_data}. Считается пустым.")
                         completed_user_ids = []
-                except (json.JSONDecodeError, TypeError, ValueError) as e:
+                except (orjson.JSONDecodeError, TypeError, ValueError) as e:
                     logging.warning(f"Ошибка парсинга 'Статусы' для задачи {task_id}: {e}. Считается пустым.")
                     completed_user_ids = []
        
             
             tasks[task_id] = {
-                "text": str(row.get("Текст", "")).strip(),
-                "link": str(row.get("Ссылка", "")).strip(),
-                "deadline": str(row.get("Дедлайн", "")).strip(),
-                "creator_initials": str(row.get("Инициалы", "")).strip(),
-                "creator_id": str(row.get("ID создателя", "")).strip(),
+                "text": text.strip(),
+                "link": link.strip(),
+                "deadline": deadline.strip(),
+                "creator_initials": creator_initials.strip(),
+                "creator_id": creator_id.strip(),
                 "assigned_to": assigned_user_ids,
                 # --- Исправлено: Теперь всегда используем ключ "completed_by" в памяти ---
                 "completed_by": completed_user_ids, 
             }
             
-            logging.debug(f"Задача {task_id}: Финальное значение 'assigned_to' = {tasks[task_id]['assigned_to']} (типы: {[type(uid) for uid in tasks[task_id]['assigned_to']]})")
+            logging.debug("Задача %s: Финальное значение 'assigned_to' = %s", task_id, assigned_user_ids)
         logging.info(f"✅ Загружено {len(tasks)} задач из Google Sheets")
         
     except Exception as e: # <-- Этот except корректно завершает блок try
@@ -919,11 +1192,11 @@ async def assign_tasks_to_users(task_ids: list[str], user_ids: list[int], sheet=
         return
     try:
         if sheet is None:
-            sheet = get_tasks_sheet()
+            sheet = await run_in_thread(get_tasks_sheet)
         # Преобразуем user_ids в строку, разделенную запятыми
         assigned_users_str = ", ".join(map(str, user_ids))
         # Получаем все значения столбца ID задачи (A)
-        task_id_col_values = sheet.col_values(1) # 1 = столбец A
+        task_id_col_values = await run_sheets_read(sheet.col_values, 1) # 1 = столбец A
         # Создаем словарь {task_id: row_number}
         task_id_to_row = {str(task_id_col_values[i]).strip(): i + 1 for i in range(len(task_id_col_values))}
         batch_updates = []
@@ -943,7 +1216,7 @@ async def assign_tasks_to_users(task_ids: list[str], user_ids: list[int], sheet=
                 logging.warning(f"Строка для задачи {task_id} не найдена при назначении.")
         if batch_updates:
             # Выполняем пакетное обновление
-            sheet.batch_update(batch_updates)
+            await run_in_thread(sheet.batch_update, batch_updates)
             logging.info(f"✅ Назначено {updated_count} задач {len(user_ids)} пользователям.")
         else:
             logging.warning("Не найдено строк для обновления при назначении задач.")
@@ -976,7 +1249,7 @@ async def cancel_add_task_text(message: types.Message, state: FSMContext):
         # Возврат в меню управления задачами
         await message.answer("Добавление задачи отменено.", reply_markup=tasks_admin_keyboard())
 
-@dp.message(TaskStates.add_text)
+@dp.message(TaskStates.add_text, F.text)
 async def add_task_link(message: types.Message, state: FSMContext):
     await state.update_data(text=message.text)
     await message.answer("🔗 Пришлите ссылку на Google Sheets (или /skip):", reply_markup=cancel_keyboard())
@@ -992,7 +1265,7 @@ async def cancel_add_task_link(message: types.Message, state: FSMContext):
     else:
         await message.answer("Добавление задачи отменено.", reply_markup=tasks_admin_keyboard())
 
-@dp.message(TaskStates.add_link)
+@dp.message(TaskStates.add_link, F.text)
 async def add_task_deadline(message: types.Message, state: FSMContext):
     link = message.text if message.text != "/skip" else None
     await state.update_data(link=link)
@@ -1009,7 +1282,7 @@ async def cancel_add_task_deadline(message: types.Message, state: FSMContext):
     else:
         await message.answer("Добавление задачи отменено.", reply_markup=tasks_admin_keyboard())
 
-@dp.message(TaskStates.add_deadline)
+@dp.message(TaskStates.add_deadline, F.text)
 async def save_task_handler(message: types.Message, state: FSMContext):
     data = await state.get_data()
     deadline = message.text if message.text != "/skip" else None
@@ -1054,16 +1327,16 @@ async def delete_task(task_id: str, admin_user_id: int) -> bool:
         bool: True, если задача успешно удалена, False в противном случае.
     """
     try:
-        sheet = get_tasks_sheet()
-        # Находим ячейку с task_id в первом столбце (ID задачи)
-        cell = sheet.find(task_id, in_column=1) # Ищем в столбце A (индекс 1)
+        sheet = await run_in_thread(get_tasks_sheet)
+        # Находим строку с task_id в первом столбце (ID задачи)
+        row = await run_sheets_read(find_task_row, sheet, task_id)
         
-        if not cell:
+        if not row:
             logging.warning(f"Попытка удаления несуществующей задачи {task_id} админом {admin_user_id}")
             return False
 
         # Удаляем всю строку
-        sheet.delete_rows(cell.row)
+        await run_in_thread(sheet.delete_rows, row)
         logging.info(f"Задача {task_id} успешно удалена админом {admin_user_id}")
         return True
 
@@ -1097,7 +1370,7 @@ async def delete_task_start(message: types.Message, state: FSMContext):
     await state.set_state(TaskStates.delete_task)
 
 
-@dp.message(TaskStates.delete_task)
+@dp.message(TaskStates.delete_task, F.text)
 async def delete_task_handler(message: types.Message, state: FSMContext):
     if message.from_user.id not in ADMINS:
         return
@@ -1178,11 +1451,7 @@ async def send_tasks_menu(message: types.Message, state: FSMContext):
         return
     
     await state.update_data(tasks=tasks)
-    keyboard = create_keyboard(
-        ["Отправить все", "Выбрать задачи", "🔙 Назад"],
-        (2, 1)
-    )
-    await message.answer("Выберите действие:", reply_markup=keyboard)
+    await message.answer("Выберите действие:", reply_markup=TASK_SEND_ACTION_KB)
     await state.set_state(TaskStates.select_action)
 
 @dp.message(TaskStates.select_action, F.text == "Отправить все")
@@ -1199,10 +1468,7 @@ async def send_all_tasks(message: types.Message, state: FSMContext):
 
     await message.answer(
         f"✅ Выбраны все задачи: {len(tasks)} шт.\nВыберите аудиторию:",
-        reply_markup=create_keyboard(
-            ["Всем пользователям", "По должности", "Вручную", "🔙 Назад"],
-            (2, 2)
-        )
+        reply_markup=TASK_AUDIENCE_KB
     )
     await state.set_state(TaskStates.select_audience)
 
@@ -1220,7 +1486,7 @@ async def select_action_to_send(message: types.Message, state: FSMContext):
     await state.set_state(TaskStates.input_task_ids)
 
 
-@dp.message(TaskStates.input_task_ids)
+@dp.message(TaskStates.input_task_ids, F.text)
 async def process_task_ids(message: types.Message, state: FSMContext):
     data = await state.get_data()
     all_tasks = data['tasks']
@@ -1268,14 +1534,20 @@ async def process_task_ids(message: types.Message, state: FSMContext):
     await message.answer(
         f"✅ Готово к отправке: {len(valid_tasks)} задач\n"
         "Выберите аудиторию:",
-        reply_markup=create_keyboard(["Всем пользователям","По должности", "Вручную", "🔙 Назад"], (2, 2))
+        reply_markup=TASK_AUDIENCE_KB
     )
     await state.set_state(TaskStates.select_audience)
 
 
 @dp.message(TaskStates.select_audience, F.text == "Всем пользователям")
 async def send_to_all_users(message: types.Message, state: FSMContext):
-    user_ids = users_sheet.col_values(1)[1:] # Предполагаем, что ID в первом столбце, без заголовка
+    # ID всех пользователей из индекса в кэше, без чтения столбца из Google Sheets
+    users_by_id = await get_users_index()
+    if users_by_id is None:
+        await message.answer("❌ Не удалось загрузить список пользователей. Попробуйте позже.", reply_markup=tasks_admin_keyboard())
+        await state.clear()
+        return
+    user_ids = list(users_by_id)
     await state.update_data(user_ids=user_ids)
     # --- Изменено: Переход в новое состояние ---
     await state.set_state(TaskStates.review_selection)
@@ -1310,7 +1582,7 @@ async def ask_for_manual_ids(message: types.Message, state: FSMContext):
             pass
 
 
-@dp.message(TaskStates.input_position)
+@dp.message(TaskStates.input_position, F.text)
 async def process_position_filter(message: types.Message, state: FSMContext):
     position_input = message.text.strip().lower()
     try:
@@ -1342,7 +1614,7 @@ async def cancel_manual_user_input(message: types.Message, state: FSMContext):
     # Убедитесь, что функция tasks_admin_keyboard() определена и доступна
     await message.answer("❌ Ввод ID пользователей отменён.", reply_markup=tasks_admin_keyboard())
 
-@dp.message(TaskStates.input_manual_ids)
+@dp.message(TaskStates.input_manual_ids, F.text)
 async def handle_manual_user_ids(message: types.Message, state: FSMContext):
     user_ids = [uid.strip() for uid in message.text.split(",") if uid.strip().isdigit()]
     if not user_ids:
@@ -1392,7 +1664,7 @@ async def review_selection_summary(message: types.Message, state: FSMContext):
     await message.answer(
         summary_text,
         parse_mode=ParseMode.MARKDOWN,
-        reply_markup=create_keyboard(["📤 Подтвердить отправку", "❌ Отмена"], (2,))
+        reply_markup=TASK_SEND_CONFIRM_KB
     )
 
 async def send_selected_tasks(selected_tasks: dict, user_ids: list):
@@ -1415,23 +1687,6 @@ async def send_selected_tasks(selected_tasks: dict, user_ids: list):
     return results
 
 
-@dp.message(TaskStates.input_manual_ids)
-async def handle_manual_user_ids(message: types.Message, state: FSMContext):
-    user_ids = [uid.strip() for uid in message.text.split(",") if uid.strip().isdigit()]
-
-    if not user_ids:
-        await message.answer("❌ Нет валидных ID. Попробуйте снова.")
-        return
-
-    await state.update_data(user_ids=user_ids)
-
-    await message.answer(
-        f"✅ Указано ID: {len(user_ids)}\n📤 Подтвердите отправку задач.",
-        reply_markup=create_keyboard(["📤 Подтвердить отправку", "❌ Отмена"], (2,))
-    )
-    await state.set_state(TaskStates.confirmation)
-
-
 @dp.message(F.text == "🔙 Назад")
 async def handle_back_from_tasks(message: types.Message, state: FSMContext):
     """Обработчик кнопки Назад в меню задач"""
@@ -1450,6 +1705,65 @@ async def run_in_thread(func, *args, **kwargs):
     return await asyncio.to_thread(func, *args, **kwargs)
 
 
+def is_retryable_sheets_error(error: APIError) -> bool:
+    """Квота (429) и временные ошибки сервера Google (5xx)"""
+    status = getattr(error.response, 'status_code', 0)
+    return status == 429 or status >= 500
+
+
+async def run_sheets_read(func, *args, **kwargs):
+    """
+    Чтение из Google Sheets в потоке с повторами при превышении квоты и 5xx.
+    Пауза растёт экспоненциально (со случайной добавкой) и проходит в event loop, а не в потоке.
+    Только для чтений: повтор записи мог бы задвоить строки.
+    """
+    for attempt in range(1, SHEETS_READ_ATTEMPTS + 1):
+        try:
+            return await asyncio.to_thread(func, *args, **kwargs)
+        except APIError as e:
+            if attempt == SHEETS_READ_ATTEMPTS or not is_retryable_sheets_error(e):
+                raise
+            delay = SHEETS_RETRY_BASE_DELAY * 2 ** (attempt - 1) + random.uniform(0, 1)
+            logging.warning(f"⏳ Google Sheets: {e}. Повтор {attempt}/{SHEETS_READ_ATTEMPTS - 1} через {delay:.1f} с")
+            await asyncio.sleep(delay)
+
+
+telegram_send_bucket = AsyncTokenBucket(rate=TELEGRAM_SEND_RATE, capacity=TELEGRAM_SEND_RATE)
+
+
+async def send_rate_limited(send_method, *args, **kwargs):
+    """
+    Массовая отправка через общий лимит telegram_send_bucket.
+    При TelegramRetryAfter приостанавливаются все массовые отправки на retry_after секунд,
+    затем сообщение отправляется повторно (один раз).
+    """
+    await telegram_send_bucket.acquire()
+    try:
+        return await send_method(*args, **kwargs)
+    except TelegramRetryAfter as e:
+        logging.warning(f"⏳ Лимит Telegram: массовые отправки приостановлены на {e.retry_after} с")
+        telegram_send_bucket.pause(e.retry_after)
+        await telegram_send_bucket.acquire()
+        return await send_method(*args, **kwargs)
+
+
+background_tasks: set = set()
+
+
+def _on_background_done(task: asyncio.Task) -> None:
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logging.error(f"❌ Ошибка фоновой задачи {task.get_name()}: {task.exception()}")
+
+
+def run_in_background(coro) -> asyncio.Task:
+    """Запуск корутины без ожидания: ответ пользователю не ждёт второстепенных RPC"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(_on_background_done)
+    return task
+
+
 @dp.callback_query(F.data.startswith("task_done:"))
 async def mark_task_done(callback: types.CallbackQuery):
     # ⚡ быстрый ответ, чтобы query не протух
@@ -1457,23 +1771,25 @@ async def mark_task_done(callback: types.CallbackQuery):
 
     task_id = callback.data.split(":")[1]
     user_id = callback.from_user.id
-    sheet = get_tasks_sheet()
+    sheet = await run_in_thread(get_tasks_sheet)
 
     try:
-        # ⚡ поиск в отдельном потоке
-        cell = await run_in_thread(sheet.find, task_id)
-        if not cell:
+        # ⚡ один запрос в отдельном потоке: столбец ID (A) и столбец статусов (I)
+        ids_range, statuses_range = await run_sheets_read(sheet.batch_get, ["A:A", "I:I"])
+        task_ids = [cells[0] if cells else "" for cells in ids_range]
+        try:
+            row = task_ids.index(str(task_id)) + 1
+        except ValueError:
             await callback.message.answer("❌ Задача не найдена")
             return
 
-        # ⚡ чтение ячейки в отдельном потоке
-        statuses_raw = await run_in_thread(sheet.cell, cell.row, 9)
-        statuses_raw = statuses_raw.value if statuses_raw else ""
+        statuses_cells = statuses_range[row - 1] if row <= len(statuses_range) else []
+        statuses_raw = str(statuses_cells[0]) if statuses_cells else ""
 
         try:
-            statuses_data = json.loads(statuses_raw) if statuses_raw.strip() else {}
-        except (json.JSONDecodeError, TypeError):
-            logging.warning(f"Неверный формат JSON для задачи {task_id} в строке {cell.row}. Создаю новый.")
+            statuses_data = orjson.loads(statuses_raw) if statuses_raw.strip() else {}
+        except (orjson.JSONDecodeError, TypeError):
+            logging.warning(f"Неверный формат JSON для задачи {task_id} в строке {row}. Создаю новый.")
             statuses_data = {}
 
         if "completed_by" not in statuses_data:
@@ -1486,15 +1802,12 @@ async def mark_task_done(callback: types.CallbackQuery):
         statuses_data["completed_by"].append(str(user_id))
 
         # ⚡ запись в отдельном потоке
-        await run_in_thread(sheet.update_cell, cell.row, 9, json.dumps(statuses_data, ensure_ascii=False))
+        await run_in_thread(sheet.update_cell, row, 9, json_dumps(statuses_data))
 
         await callback.message.answer("✅ Отмечено как выполнено")
 
         try:
-            new_markup = types.InlineKeyboardMarkup(inline_keyboard=[
-                [types.InlineKeyboardButton(text="✔️ Выполнено", callback_data="task_already_done")]
-            ])
-            await callback.message.edit_reply_markup(reply_markup=new_markup)
+            await callback.message.edit_reply_markup(reply_markup=TASK_ALREADY_DONE_KB)
         except Exception as e:
             logging.warning(f"Не удалось обновить сообщение задачи {task_id}: {e}")
 
@@ -1573,31 +1886,31 @@ async def check_deadlines():
                             )
                     # -------------------------------------------------------------------
 
-                    # Отправляем уведомления
-                    for user_id_str in users_to_notify:
+                    # Отправляем уведомления параллельно (в пределах общего лимита TELEGRAM_SEND_RATE)
+                    task_kb = get_task_keyboard(task_id)
+
+                    async def notify_user(user_id_str: str) -> bool:
                         try:
                             user_id_int = int(user_id_str)
-                            
-                        
-                            
-                            task_kb = get_task_keyboard(task_id) 
-                            
-                            await bot.send_message(
+                        except ValueError:
+                            logging.error(f"Неверный формат ID пользователя '{user_id_str}' для задачи {task_id}")
+                            return False
+                        try:
+                            await send_rate_limited(
+                                bot.send_message,
                                 user_id_int,
                                 full_notification_text, # Используем сформированный текст
                                 parse_mode=ParseMode.MARKDOWN, # Используем Markdown
                                 reply_markup=task_kb # Прикрепляем кнопку "Выполнено"
                             )
-            
-                            
                             logging.info(f"✉️ Уведомление о просроченной задаче {task_id} отправлено пользователю {user_id_int}")
-                            notified_count += 1
-                            # Небольшая пауза между сообщениями для соблюдения лимитов API
-                            await asyncio.sleep(0.1) 
-                        except ValueError:
-                            logging.error(f"Неверный формат ID пользователя '{user_id_str}' для задачи {task_id}")
-                        except Exception as send_e: # Ловим другие ошибки отправки (заблокировал бота и т.д.)
-                             logging.error(f"Ошибка отправки уведомления о просроченной задаче {task_id} пользователю {user_id_str}: {send_e}")
+                            return True
+                        except Exception as send_e: # Ловим ошибки отправки (заблокировал бота и т.д.)
+                            logging.error(f"Ошибка отправки уведомления о просроченной задаче {task_id} пользователю {user_id_str}: {send_e}")
+                            return False
+
+                    results = await asyncio.gather(*(notify_user(user_id_str) for user_id_str in users_to_notify))
+                    notified_count += sum(results)
 
             logging.info(f"🔚 Проверка просроченных задач завершена. Отправлено {notified_count} уведомлений.")
         except Exception as e:
@@ -1629,7 +1942,7 @@ async def confirm_task_dispatch(message: types.Message, state: FSMContext):
         if task_ids_to_assign and user_ids_int:
             # Назначаем задачи пользователям в Google Sheets
             # Передаем sheet, чтобы не переоткрывать соединение
-            sheet = get_tasks_sheet() 
+            sheet = await run_in_thread(get_tasks_sheet)
             await assign_tasks_to_users(task_ids_to_assign, user_ids_int, sheet=sheet)
             await message.answer("✅ Задачи успешно назначены выбранным пользователям.")
         else:
@@ -1643,26 +1956,38 @@ async def confirm_task_dispatch(message: types.Message, state: FSMContext):
     total_attempts = len(user_ids) * len(selected_tasks)
     if total_attempts > 100: # <-- Пример: для больших рассылок показываем прогресс
          progress_msg = await message.answer(f"📨 Отправка... (0/{len(user_ids)})")
-    for i, uid in enumerate(user_ids):
-        for task_id, task in selected_tasks.items():
-            try:  
-                await bot.send_message(
+    # Сообщения формируются один раз для всех получателей
+    task_messages = [
+        (format_task_message(task_id, task), get_task_keyboard(task_id))
+        for task_id, task in selected_tasks.items()
+    ]
+    done_users = 0
+
+    async def send_to_user(uid: str) -> None:
+        nonlocal success, failed, done_users
+        # Задачи одному пользователю уходят по порядку, разные пользователи - параллельно
+        for text, keyboard in task_messages:
+            try:
+                await send_rate_limited(
+                    bot.send_message,
                     int(uid),
-                    format_task_message(task_id, task),
+                    text,
                     parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=get_task_keyboard(task_id)
+                    reply_markup=keyboard
                 )
                 success += 1
-                await asyncio.sleep(0.05) # немного уменьшена пауза
             except Exception as e:
-                logging.warning(f"Ошибка отправки задачи {task_id} пользователю {uid}: {e}")
+                logging.warning(f"Ошибка отправки задачи пользователю {uid}: {e}")
                 failed += 1
+        done_users += 1
         # Обновляем прогресс, если нужно
-        if total_attempts > 100 and (i + 1) % 10 == 0: # <-- Обновляем каждые 10 пользователей
+        if total_attempts > 100 and done_users % 10 == 0: # <-- Обновляем каждые 10 пользователей
             try:
-                await progress_msg.edit_text(f"📨 Отправка... ({i+1}/{len(user_ids)})")
+                await progress_msg.edit_text(f"📨 Отправка... ({done_users}/{len(user_ids)})")
             except:
                 pass # Игнорируем ошибки редактирования прогресса
+
+    await asyncio.gather(*(send_to_user(uid) for uid in user_ids))
     # Финальный отчет
     report = f"📊 Отправка завершена:\n• Пользователей: {len(user_ids)}\n• Задач каждому: {len(selected_tasks)}\n• Успешных отправок: {success}\n• Ошибок: {failed}"
     await message.answer(report, reply_markup=tasks_admin_keyboard())
@@ -1780,7 +2105,7 @@ async def handle_stats_from_main_menu(message: types.Message, state: FSMContext)
         await message.answer(
             stats_text,
             parse_mode=ParseMode.MARKDOWN,
-            reply_markup=create_keyboard(["Детали по задаче", "🔙 Назад"], (1,))
+            reply_markup=TASK_STATS_KB
         )
         await state.set_state(TaskStates.view_stats)
         logging.info("Статистика успешно отправлена.")
@@ -1811,7 +2136,7 @@ async def ask_for_task_details(message: types.Message, state: FSMContext):
 
 
 # --- Исправленный фрагмент show_task_details с markdown_decoration ---
-@dp.message(TaskStates.input_task_id_for_details)
+@dp.message(TaskStates.input_task_id_for_details, F.text)
 async def show_task_details(message: types.Message, state: FSMContext):
     input_task_id = str(message.text.strip())
     data = await state.get_data()
@@ -1910,8 +2235,15 @@ async def show_task_details(message: types.Message, state: FSMContext):
     await message.answer(response, parse_mode=ParseMode.MARKDOWN, reply_markup=tasks_admin_keyboard())
     await state.clear()
 
+# =======================ГЛАВНОЕ МЕНЮ =======================
+# Только вне сценариев: текст в состоянии FSM (артикул, отзыв, причина) забирают обработчики состояний
+@dp.message(StateFilter(None), F.text.in_(frozenset(MAIN_MENU_BUTTONS)))
+async def route_main_menu(message: types.Message, state: FSMContext):
+    """Единая точка входа для кнопок главного меню: выбор обработчика по словарю"""
+    await MAIN_MENU_ROUTES[message.text](message, state)
+
+
 # =======================РАБОТА С ЭКСПО =======================
-@dp.message(F.text == "🖼️ Экспо")
 async def handle_expo_start(message: types.Message, state: FSMContext):
     """Начало работы с Экспо"""
     user_data = await get_user_data(str(message.from_user.id))
@@ -1927,7 +2259,7 @@ async def handle_expo_start(message: types.Message, state: FSMContext):
     await state.set_state(ExpoStates.article_input)
 
 
-@dp.message(ExpoStates.article_input)
+@dp.message(ExpoStates.article_input, F.text)
 async def process_expo_article(message: types.Message, state: FSMContext):
     article = message.text.strip()
     if not re.match(r'^\d{4,10}$', article):
@@ -1958,12 +2290,7 @@ async def process_expo_article(message: types.Message, state: FSMContext):
         f"🏭 Поставщик: {product_info['Поставщик']}\n\n"
         "Выберите действие:"
     )
-    kb = ReplyKeyboardBuilder()
-    kb.button(text="➕ Поставить на Экспо")
-    kb.button(text="➖ Снять с Экспо")
-    kb.button(text="❌ Отмена")
-    kb.adjust(2, 1)
-    await message.answer(response, reply_markup=kb.as_markup(resize_keyboard=True))
+    await message.answer(response, reply_markup=EXPO_ACTION_KB)
     await state.set_state(ExpoStates.action_selection)
 
 
@@ -1980,7 +2307,7 @@ async def handle_expo_action(message: types.Message, state: FSMContext):
         await state.set_state(ExpoStates.confirmation)
 
 
-@dp.message(ExpoStates.quantity_input)
+@dp.message(ExpoStates.quantity_input, F.text)
 async def process_expo_quantity(message: types.Message, state: FSMContext):
     try:
         quantity = int(message.text)
@@ -2075,16 +2402,9 @@ async def process_quantities_list(message: types.Message, state: FSMContext):
 
 @dp.message(OrderStates.batch_shop_selection)
 async def process_batch_shop_selection(message: types.Message, state: FSMContext):
-    # Словарь для сопоставления текста кнопки с номером магазина
-    shop_mapping = {
-        "🏪 Магазин 7": "7",
-        "🏪 Магазин 14": "14",
-        "🏪 Магазин 69": "69",
-        "🏪 Магазин 94": "94"
-    }
 
-    if message.text in shop_mapping:
-        selected_shop = shop_mapping[message.text]
+    if message.text in QUICK_SHOP_MAPPING:
+        selected_shop = QUICK_SHOP_MAPPING[message.text]
         await state.update_data(selected_shop=selected_shop)
         # Переходим к получению информации и выводу
         await continue_batch_order_process(message, state)
@@ -2128,6 +2448,7 @@ async def continue_batch_order_process(message: types.Message, state: FSMContext
                 'article': item['article'],
                 'quantity': item['quantity'],
                 'name': product_info['Название'],
+                'order_date': product_info.get('Дата заказа', 'N/A'),
                 'delivery_date': product_info['Дата поставки'],
                 'top_0': is_top_0,
                 'department': item_department,  # <-- Сохраняем
@@ -2210,16 +2531,10 @@ async def confirm_batch_order(message: types.Message, state: FSMContext):
     skipped_count = 0
 
     # --- Обработка ВСЕХ артикулов --- (и ТОП 0, и обычные)
+    # Данные товаров уже получены в continue_batch_order_process и сохранены в valid_items
     for item in valid_items:
-        # --- Получаем информацию о товаре ---
-        product_info = await get_product_info(item['article'], selected_shop)
-        if not product_info:
-            logging.error(f"❌ Товар {item['article']} не найден в магазине {selected_shop} при добавлении в очередь.")
-            skipped_count += 1
-            continue
-
         # --- Получаем отдел товара ---
-        item_department = product_info.get('Отдел', 'Не указано').strip()
+        item_department = item.get('department', 'Не указано')
         if item_department == 'Не указано' or not item_department:
             logging.error(f"❌ Отдел не указан для артикула {item['article']} при добавлении в очередь.")
             skipped_count += 1
@@ -2234,11 +2549,11 @@ async def confirm_batch_order(message: types.Message, state: FSMContext):
             'department': item_department, # <-- Отдел товара
             'user_name': user_name,
             'user_position': user_position,
-            'product_name': product_info['Название'],
-            'supplier_name': product_info.get('Поставщик', 'Не указано').strip(),
-            'order_date': product_info.get('Дата заказа', 'N/A'), # или 'N/A'
-            'delivery_date': product_info.get('Дата поставки', 'N/A'), # или 'N/A'
-            'top_0': product_info.get('Топ в магазине', '0') == '0', # <-- Определяем здесь
+            'product_name': item['name'],
+            'supplier_name': item.get('supplier_name', 'Не указано'),
+            'order_date': item.get('order_date', 'N/A'),
+            'delivery_date': item.get('delivery_date', 'N/A'),
+            'top_0': item['top_0'],
             'batch_order': True # <-- Флаг, что это из множественного ввода
         }
 
@@ -2365,7 +2680,7 @@ async def create_approval_request(
 ) -> bool:
     """Создает запись запроса на одобрение в БД."""
     try:
-        serialized_data = json.dumps(user_data, ensure_ascii=False, default=str) # Сериализуем данные FSM
+        serialized_data = json_dumps(user_data) # Сериализуем данные FSM
         with get_db_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
@@ -2400,8 +2715,8 @@ async def get_pending_approval_request(user_id: int) -> Optional[dict]:
                 # Преобразуем sqlite3.Row в словарь и десериализуем user_data
                 result = dict(row)
                 try:
-                    result['user_data'] = json.loads(result['user_data'])
-                except json.JSONDecodeError as e:
+                    result['user_data'] = orjson.loads(result['user_data'])
+                except orjson.JSONDecodeError as e:
                     logging.error(f"❌ Ошибка десериализации user_data для запроса {result['request_id']}: {e}")
                     result['user_data'] = {}
                 return result
@@ -2471,8 +2786,8 @@ async def get_approval_request_by_id(request_id: str) -> Optional[dict]:
             if row:
                 result = dict(row)
                 try:
-                    result['user_data'] = json.loads(result['user_data'])
-                except json.JSONDecodeError as e:
+                    result['user_data'] = orjson.loads(result['user_data'])
+                except orjson.JSONDecodeError as e:
                     logging.error(f"❌ Ошибка десериализации user_data для запроса {request_id}: {e}")
                     result['user_data'] = {}
                 return result
@@ -2598,7 +2913,7 @@ async def handle_manager_approval(callback: types.CallbackQuery, state: FSMConte
 
 
 
-@dp.message(ManagerApprovalStates.awaiting_reject_comment)
+@dp.message(ManagerApprovalStates.awaiting_reject_comment, F.text)
 async def handle_manager_reject_comment(message: types.Message, state: FSMContext):
     """Обработка текстового комментария менеджера при отказе."""
     manager_id = message.from_user.id
@@ -2898,8 +3213,7 @@ def initialize_order_queue_table():
 async def add_order_to_queue(user_id: int, order_data: dict) -> bool:
     """Добавляет заказ в очередь на обработку."""
     try:
-        import json
-        serialized_data = json.dumps(order_data, ensure_ascii=False, default=str)
+        serialized_data = json_dumps(order_data)
         with get_db_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
@@ -2933,14 +3247,14 @@ def get_pending_orders(limit: int = 10) -> list:
             orders = []
             for row in rows:
                 try:
-                    order_data = json.loads(row['order_data']) if isinstance(row['order_data'], str) else row['order_data']
+                    order_data = orjson.loads(row['order_data']) if isinstance(row['order_data'], str) else row['order_data']
                     orders.append({
                         'id': row['id'],
                         'user_id': row['user_id'],
                         'order_data': order_data,
                         'attempt_count': row['attempt_count']
                     })
-                except json.JSONDecodeError as je:
+                except orjson.JSONDecodeError as je:
                     logging.error(f"❌ Ошибка десериализации order_data для записи {row['id']}: {je}")
                     # Можно пометить заказ как 'failed' здесь, если нужно
             return orders
@@ -3006,6 +3320,52 @@ def get_order_queue_stats() -> dict:
         return {'pending': 0, 'processing': 0, 'completed': 0, 'failed': 0}
 
 
+def build_order_row(order_item: dict) -> list:
+    """
+    Строка заказа A:R для листа отдела.
+    None (null) API пропускает, поэтому столбцы F-J и L-Q не затираются.
+    """
+    order_data = order_item['order_data']
+    return [
+        order_data['selected_shop'],                                   # A
+        int(order_data['article']),                                    # B
+        order_data['order_reason'],                                    # C
+        now_minute_str(),                                              # D
+        f"{order_data['user_name']}, {order_data['user_position']}",   # E
+        None, None, None, None, None,                                  # F-J
+        int(order_data['quantity']),                                   # K
+        None, None, None, None, None, None,                            # L-Q
+        order_item['user_id']                                          # R
+    ]
+
+
+async def handle_order_failure(bot_instance, order_item: dict, error_msg: str, max_retries: int = 5) -> None:
+    """Отметка ошибки записи заказа; после последней попытки - уведомление администраторов"""
+    order_id = order_item['id']
+    user_id = order_item['user_id']
+    order_data = order_item['order_data']
+    logging.error(f"❌ Ошибка при записи заказа ID {order_id} для пользователя {user_id}: {error_msg}")
+    
+    # Обновляем статус на 'failed' и сохраняем ошибку
+    update_order_status(order_id, 'failed', error_message=error_msg)
+    
+    # Если это была последняя попытка, уведомляем админа
+    if order_item['attempt_count'] + 1 >= max_retries:
+        for admin_id in ADMINS:
+            try:
+                admin_msg = (
+                    f"🚨 Окончательная ошибка записи заказа из очереди!\n"
+                    f"• ID записи в БД: <code>{order_id}</code>\n"
+                    f"• Пользователь: <code>{user_id}</code>\n"
+                    f"• Артикул: <code>{order_data.get('article', 'N/A')}</code>\n"
+                    f"• Магазин: <code>{order_data.get('selected_shop', 'N/A')}</code>\n"
+                    f"• Ошибка: <pre>{error_msg[:300]}</pre>"
+                )
+                await bot_instance.send_message(admin_id, admin_msg, parse_mode='HTML')
+            except Exception as admin_notify_err:
+                logging.error(f"Не удалось уведомить админа {admin_id}: {admin_notify_err}")
+
+
 async def process_order_queue(bot_instance):
     """Фоновый обработчик очереди заказов."""
     logging.info("🚀 Запущен обработчик очереди заказов (воркер)")
@@ -3026,69 +3386,39 @@ async def process_order_queue(bot_instance):
             
             logging.info(f"📥 Найдено {len(pending_orders)} заказов для обработки.")
             
-            # --- Обрабатываем каждый заказ по очереди ---
+            # --- Группируем заказы по отделам: одна запись values.append на отдел ---
+            orders_by_department = {}
             for order_item in pending_orders:
-                order_id = order_item['id']
-                user_id = order_item['user_id']
-                order_data = order_item['order_data']
-                attempt_count = order_item['attempt_count']
-                max_retries = 5
-                
                 # Помечаем заказ как "в обработке"
-                update_order_status(order_id, 'processing')
-                logging.info(f"⚙️ Начало обработки заказа ID {order_id} (попытка {attempt_count + 1}) для пользователя {user_id}...")
-                
+                update_order_status(order_item['id'], 'processing')
+                logging.info(f"⚙️ Начало обработки заказа ID {order_item['id']} (попытка {order_item['attempt_count'] + 1}) для пользователя {order_item['user_id']}...")
+                try:
+                    row = build_order_row(order_item)
+                    department = order_item['order_data']['department']
+                except Exception as e:
+                    await handle_order_failure(bot_instance, order_item, str(e))
+                    continue
+                orders_by_department.setdefault(department, []).append((order_item, row))
+
+            for department, items in orders_by_department.items():
                 try:
                     # --- ОСНОВНАЯ ОПЕРАЦИЯ ЗАПИСИ В GOOGLE SHEETS ---
-                    department_sheet = orders_spreadsheet.worksheet(order_data['department'])
-                    next_row = len(department_sheet.col_values(1)) + 1
-
-                    updates = [
-                        {'range': f'A{next_row}', 'values': [[order_data['selected_shop']]]},
-                        {'range': f'B{next_row}', 'values': [[int(order_data['article'])]]},
-                        {'range': f'C{next_row}', 'values': [[order_data['order_reason']]]},
-                        {'range': f'D{next_row}', 'values': [[datetime.now().strftime("%d.%m.%Y %H:%M")]]},
-                        {'range': f'E{next_row}', 'values': [[f"{order_data['user_name']}, {order_data['user_position']}"]]},
-                        {'range': f'K{next_row}', 'values': [[int(order_data['quantity'])]]},
-                        {'range': f'R{next_row}', 'values': [[user_id]]}
-                    ]
-                    department_sheet.batch_update(updates)
+                    department_sheet = await run_in_thread(get_worksheet, orders_spreadsheet, department)
+                    rows = [row for _, row in items]
+                    response = await run_in_thread(department_sheet.append_rows, rows, table_range='A1')
+                    updated_range = response.get('updates', {}).get('updatedRange', '')
                     # --- КОНЕЦ ОПЕРАЦИИ ЗАПИСИ ---
-                    
-                    # --- УСПЕХ ---
-                    update_order_status(order_id, 'completed')
-                    logging.info(f"✅ Заказ ID {order_id} для пользователя {user_id} успешно записан в таблицу {order_data['department']} строка {next_row}")
-                    
-                    # (Опционально) Уведомляем пользователя об успехе
-                    # try:
-                    #     await bot_instance.send_message(user_id, "✅ Ваш заказ успешно записан в таблицу!")
-                    # except Exception as user_notify_err:
-                    #     logging.warning(f"Не удалось уведомить пользователя {user_id} об успешной записи заказа: {user_notify_err}")
-                    
                 except Exception as e:
-                    # --- ОШИБКА ---
-                    error_msg = str(e)
-                    logging.error(f"❌ Ошибка при записи заказа ID {order_id} для пользователя {user_id}: {error_msg}", exc_info=True)
-                    
-                    # Обновляем статус на 'failed' и сохраняем ошибку
-                    update_order_status(order_id, 'failed', error_message=error_msg)
-                    
-                    # Если это была последняя попытка, уведомляем админа
-                    if attempt_count + 1 >= max_retries:
-                        for admin_id in ADMINS:
-                            try:
-                                admin_msg = (
-                                    f"🚨 Окончательная ошибка записи заказа из очереди!\n"
-                                    f"• ID записи в БД: <code>{order_id}</code>\n"
-                                    f"• Пользователь: <code>{user_id}</code>\n"
-                                    f"• Артикул: <code>{order_data.get('article', 'N/A')}</code>\n"
-                                    f"• Магазин: <code>{order_data.get('selected_shop', 'N/A')}</code>\n"
-                                    f"• Ошибка: <pre>{error_msg[:300]}</pre>"
-                                )
-                                await bot_instance.send_message(admin_id, admin_msg, parse_mode='HTML')
-                            except Exception as admin_notify_err:
-                                logging.error(f"Не удалось уведомить админа {admin_id}: {admin_notify_err}")
-                                
+                    # --- ОШИБКА: вся пачка отдела вернётся в очередь ---
+                    for order_item, _ in items:
+                        await handle_order_failure(bot_instance, order_item, str(e))
+                    continue
+
+                # --- УСПЕХ ---
+                for order_item, _ in items:
+                    update_order_status(order_item['id'], 'completed')
+                    logging.info(f"✅ Заказ ID {order_item['id']} для пользователя {order_item['user_id']} успешно записан в таблицу {department} ({updated_range})")
+
             # Небольшая пауза между циклами обработки
             await asyncio.sleep(1)
             
@@ -3111,115 +3441,26 @@ async def process_order_queue(bot_instance):
 
 # =============================ПАРСЕР=================================
   
-def parse_supplier_data(record: dict) -> Dict[str, Any]:
-    """Парсинг данных поставщика"""
-    order_days = []
-    for key in ['День выхода заказа', 'День выхода заказа 2', 'День выхода заказа 3']:
-        value = str(record.get(key, '')).strip()
-        if value and value.isdigit():
-            order_days.append(int(value))
-    
-    delivery_days = str(record.get('Срок доставки в магазин', '0')).strip()
-
-    # --- Парсим каникулы ---
-    holidays_str = str(record.get('Каникулы список', '')).strip()
-    holidays = set()
-    if holidays_str:
-        for date_str in holidays_str.split(','):
-            date_str = date_str.strip()
-            if date_str:
-                try:
-                    date_obj = datetime.strptime(date_str, "%d.%m.%Y").date()
-                    holidays.add(date_obj)
-                except ValueError:
-                    logging.warning(f"⚠️ Некорректный формат даты каникул: {date_str}")
-
-    # --- Парсим исключения (заказы внутри каникул) ---
-    exceptions_str = str(record.get('Исключения список', '')).strip()  # <-- НОВОЕ ПОЛЕ
-    exceptions = set()
-    if exceptions_str:
-        for date_str in exceptions_str.split(','):
-            date_str = date_str.strip()
-            if date_str:
-                try:
-                    date_obj = datetime.strptime(date_str, "%d.%m.%Y").date()
-                    exceptions.add(date_obj)
-                except ValueError:
-                    logging.warning(f"⚠️ Некорректный формат даты исключения: {date_str}")
-
-    return {
-        'supplier_id': str(record.get('Номер осн. пост.', '')),
-        'order_days': sorted(list(set(order_days))),
-        'delivery_days': int(delivery_days) if delivery_days.isdigit() else 0,
-        'holidays': holidays,
-        'exceptions': exceptions  # <-- Добавляем исключения
-    }
-    
-
-def calculate_delivery_date(supplier_data: dict) -> Tuple[str, str]:
+def get_delivery_dates(shop: str, supplier_data: dict) -> Tuple[str, str]:
+    """Даты заказа и поставки из дневной таблицы магазина (расчет один раз в день на поставщика)"""
     today = datetime.now().date()
-    current_weekday = today.isoweekday()
-
-    order_days = supplier_data['order_days']
-    holidays = supplier_data.get('holidays', set())
-    exceptions = supplier_data.get('exceptions', set())
-
-    # --- 1. Найти ближайший день заказа ---
-    candidate_date = today
-    while True:
-        # Проверяем, является ли день заказа по графику
-        candidate_weekday = candidate_date.isoweekday()
-        is_scheduled_order_day = candidate_weekday in order_days
-
-        # Проверяем, является ли день исключением
-        is_exception = candidate_date in exceptions
-
-        # Если это исключение — можно заказать, даже если не день заказа
-        if is_exception:
-            order_date = candidate_date
-            break
-
-        # Если это день заказа и не каникулы — можно заказать
-        if is_scheduled_order_day and candidate_date not in holidays:
-            order_date = candidate_date
-            break
-
-        # Иначе — идём дальше
-        candidate_date += timedelta(days=1)
-
-    # --- 2. Рассчитать дату поставки ---
-    delivery_date = order_date
-    days_added = 0
-    while days_added < supplier_data['delivery_days']:
-        next_day = delivery_date + timedelta(days=1)
-        # Если следующий день — каникулы, но не исключение — пропускаем
-        if next_day in holidays and next_day not in exceptions:
-            delivery_date = next_day
-            continue
-        # Иначе — засчитываем день
-        delivery_date = next_day
-        days_added += 1
+    cache_key = f"delivery_{shop}"
+    table = cache.get(cache_key)
+    if not table or table['date'] != today:
+        table = {'date': today, 'dates': {}}
+        cache[cache_key] = table
 
-    return (
-        order_date.strftime("%d.%m.%Y"),
-        delivery_date.strftime("%d.%m.%Y")
-    )
+    supplier_id = supplier_data['supplier_id']
+    dates = table['dates'].get(supplier_id)
+    if dates is None:
+        dates = calculate_delivery_date(supplier_data)
+        table['dates'][supplier_id] = dates
+    return dates
 
 
-@profile_memory
 async def get_product_info(article: str, shop: str) -> Optional[Dict[str, Any]]:
     """Получение информации о товаре с расширенным логированием, используя SQLite"""
     try:
-        stack = inspect.stack()
-        # Обычно нас интересует вызывающая функция, которая находится под текущей (stack[1])
-        # stack[0] - это текущая функция get_product_info
-        caller_frame = stack[1] 
-        caller_info = f"{caller_frame.filename}:{caller_frame.lineno} in {caller_frame.function}"
-        logging.info(f"🔍 [TRACE] get_product_info вызвана из: {caller_info}")
-        
-        for i, frame in enumerate(stack[1:4]): # Показать 3 уровня вызова
-             logging.info(f"  {i+1}. {frame.filename}:{frame.lineno} in {frame.function}")
-        
         logging.info(f"🔍 Поиск товара: артикул={article}, магазин={shop}")
         
         # === 1. Получение данных товара из SQLite ===
@@ -3229,11 +3470,11 @@ async def get_product_info(article: str, shop: str) -> Optional[Dict[str, Any]]:
             logging.warning(f"Товар не найден в БД: артикул={article}, магазин={shop}")
             return None
             
-        logging.info(f"Найден товар: {product_data.get('Название', 'Неизвестно')}")
+        logging.debug("Найден товар: %s", product_data.get('Название', 'Неизвестно'))
 
         # === 2. Получение данных поставщика из SQLite ===
-        supplier_id = str(product_data.get("Номер осн. пост.", "")).strip()
-        logging.info(f"ID поставщика: {supplier_id}")
+        supplier_id = product_data["Номер осн. пост."]
+        logging.debug("ID поставщика: %s", supplier_id)
         
         if not supplier_id:
              # Если поставщик не указан, возвращаем базовую информацию
@@ -3241,7 +3482,7 @@ async def get_product_info(article: str, shop: str) -> Optional[Dict[str, Any]]:
              return {
                  'Артикул': article,
                  'Название': product_data.get('Название', ''),
-                 'Отдел': str(product_data.get('Отдел', '')),
+                 'Отдел': product_data['Отдел'],
                  'Магазин': shop,
                  'Поставщик': 'Товар РЦ', # Или другое значение по умолчанию
                  'Топ в магазине': product_data.get('Топ в магазине', '0'),
@@ -3257,7 +3498,7 @@ async def get_product_info(article: str, shop: str) -> Optional[Dict[str, Any]]:
             return {
                 'Артикул': article,
                 'Название': product_data.get('Название', ''),
-                'Отдел': str(product_data.get('Отдел', '')),
+                'Отдел': product_data['Отдел'],
                 'Магазин': shop,
                 'Поставщик': 'Товар РЦ', # Или product_data.get('Название осн. пост.', 'Не указано').strip()
                 'Топ в магазине': product_data.get('Топ в магазине', '0'),
@@ -3265,20 +3506,18 @@ async def get_product_info(article: str, shop: str) -> Optional[Dict[str, Any]]:
                 'Дата поставки': 'Не определена (поставщик не найден)',
             }
 
-        # === 4. Парсинг данных поставщика и расчет дат ===
-        # Парсинг данных поставщика (используем существующую функцию)
-        parsed_supplier = parse_supplier_data(supplier_data)
-        order_date, delivery_date = calculate_delivery_date(parsed_supplier)
-        holidays = parsed_supplier.get('holidays', set())
-        exceptions = parsed_supplier.get('exceptions', set())
+        # === 4. Расчет дат (данные поставщика разобраны при загрузке) ===
+        order_date, delivery_date = get_delivery_dates(shop, supplier_data)
+        holidays = supplier_data.get('holidays', set())
+        exceptions = supplier_data.get('exceptions', set())
         
         # === 5. Формирование итогового результата ===
         result = {
             'Артикул': article,
             'Название': product_data.get('Название', ''),
-            'Отдел': str(product_data.get('Отдел', '')),
+            'Отдел': product_data['Отдел'],
             'Магазин': shop,
-            'Поставщик': supplier_data.get("Название осн. пост.", "Не указано").strip(),
+            'Поставщик': supplier_data['supplier_name'],
             'Дата заказа': order_date,
             'Дата поставки': delivery_date,
             'Номер поставщика': supplier_id,
@@ -3288,39 +3527,77 @@ async def get_product_info(article: str, shop: str) -> Optional[Dict[str, Any]]:
             'Исключения': list(exceptions) if exceptions else None,   
         }
         
-        logging.info(f"Успешно получена информация: {result}")
+        # Словарь результата форматируется только при включенном DEBUG
+        logging.debug("Успешно получена информация: %s", result)
         return result
         
     except Exception as e:
         logging.exception(f"Критическая ошибка в get_product_info: {str(e)}")
         return None
 
-@profile_memory
+preload_task: Optional[asyncio.Task] = None
+
+
 async def preload_cache() -> None:
-    """Предзагрузка кэша"""
+    """
+    Предзагрузка кэша. Одновременные вызовы (плановое обновление, кнопка обновления кэша
+    у нескольких админов) объединяются: ожидают одну и ту же загрузку, а не запускают новую.
+    """
+    global preload_task
+    if preload_task is None or preload_task.done():
+        preload_task = asyncio.create_task(_preload_cache())
+    # shield: отмена одного из ожидающих не прерывает общую загрузку
+    await asyncio.shield(preload_task)
+
+
+@profile_memory
+async def _preload_cache() -> None:
+    """Загрузка пользователей и менеджеров из Google Sheets и прогрев кэша поставщиков"""
     try:
-        # Кэширование пользователей
-        users_records = users_sheet.get_all_records()
-        cache["users_data"] = pickle.dumps(users_records)
+        # Пользователи и менеджеры загружаются параллельно (два независимых запроса к Sheets)
+        managers_sheet = await run_in_thread(get_worksheet, main_spreadsheet, MANAGERS_SHEET_NAME)
+        users_records, managers_records = await asyncio.gather(
+            run_sheets_read(users_sheet.get_all_records),
+            run_sheets_read(managers_sheet.get_all_records),
+        )
         
-        managers_sheet = main_spreadsheet.worksheet(MANAGERS_SHEET_NAME)
+        # Кэширование пользователей
+        cache_users_records(users_records)
         
-        managers_records = managers_sheet.get_all_records()
         cache["managers_data"] = pickle.dumps(managers_records)
-        cache_size_managers = len(pickle.dumps(managers_records)) / 1024 / 1024
+        cache_size_managers = len(cache["managers_data"]) / 1024 / 1024
         logging.info(f"✅ Кэш менеджеров (лист '{MANAGERS_SHEET_NAME}') загружен. Размер: {cache_size_managers:.2f} MB")
         
-        cache_size = sum(len(pickle.dumps(v)) for v in cache.values()) / 1024 / 1024
+        cache_size = sum(len(v) for v in cache.values() if isinstance(v, bytes)) / 1024 / 1024
         logging.info(f"✅ Кэш пользователей загружен. Размер: {cache_size:.2f} MB")
         logging.info("✅ Кэш успешно загружен (без gamma_index)")
+
+        # Поставщики магазинов пользователей загружаются заранее и параллельно,
+        # чтобы первый запрос товара в магазине не ждал чтения всей таблицы
+        await warm_supplier_cache({user['shop'] for user in cache["users_by_id"].values()} - {"Не указан"})
     except Exception as e:
         logging.error(f"Ошибка загрузки кэша: {str(e)}")
 
 
+async def warm_supplier_cache(shops) -> None:
+    """Параллельная загрузка таблиц поставщиков магазинов в supplier_cache"""
+    semaphore = asyncio.Semaphore(SUPPLIER_PRELOAD_CONCURRENCY)
+
+    async def load_shop(shop):
+        async with semaphore:
+            supplier_map = await run_in_thread(_load_supplier_map, shop)
+        if supplier_map is not None:
+            supplier_cache[shop] = supplier_map
+
+    await asyncio.gather(*(load_shop(shop) for shop in shops))
+    logging.info(f"✅ Кэш поставщиков прогрет: {len(supplier_cache)} магазинов")
+
+
 # === Заменить полностью функцию get_product_data_from_db ===
 async def get_product_data_from_db(article: str, shop: str) -> Optional[Dict[str, Any]]:
     """
     Получение данных о товаре из SQLite по составному ключу (full_key).
+    Найденные товары кэшируются в product_cache примерно на CACHE_TTL.
 
     Args:
         article (str): Артикул товара.
@@ -3329,12 +3606,41 @@ async def get_product_data_from_db(article: str, shop: str) -> Optional[Dict[str
     Returns:
         Optional[Dict[str, Any]]: Словарь с данными товара или None, если не найден.
     """
+    cache_key = (article, shop)
+    product_data = product_cache.get(cache_key)
+    if product_data is not None:
+        return product_data
+
+    product_data = _query_product_data(article, shop)
+    if product_data is not None:
+        product_cache[cache_key] = product_data
+    return product_data
+
+
+def _product_row_to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+    """Строка articles в словарь с именами полей, ожидаемыми get_product_info.
+    Отдел и номер поставщика приводятся к строкам один раз здесь: результат кэшируется,
+    и get_product_info использует их без повторных str()/strip()"""
+    return {
+        "Магазин": row['store_number'],
+        "Отдел": str(row['department'] or ''),
+        "Артикул": row['article_code'],
+        "Название": row['name'],
+        "Гамма": row['gamma'],
+        "Номер осн. пост.": str(row['supplier_code'] or '').strip(),
+        "Название осн. пост.": row['supplier_name'],
+        "Топ в магазине": str(row['is_top_store'])
+    }
+
+
+def _query_product_data(article: str, shop: str) -> Optional[Dict[str, Any]]:
+    """Запрос данных о товаре из SQLite (без кэша)"""
     try:
         # Формируем составной ключ для точного поиска
         full_key_exact = f"{article}{shop}"
-        logging.info(f"🔍 Поиск по full_key: '{full_key_exact}'")
+        logging.debug("🔍 Поиск по full_key: '%s'", full_key_exact)
 
-        with get_db_connection() as conn:
+        with get_read_connection() as conn:  # соединение не закрывается, переиспользуется
             cursor = conn.cursor()
             
             # 1. Поиск с точным совпадением по full_key
@@ -3349,32 +3655,23 @@ async def get_product_data_from_db(article: str, shop: str) -> Optional[Dict[str
             
             if row:
                 # Преобразуем sqlite3.Row в словарь
-                logging.info(f"✅ Найден товар по точному full_key '{full_key_exact}': {row['name']}")
+                logging.debug("✅ Найден товар по точному full_key '%s': %s", full_key_exact, row['name'])
                 # Отображаем имена столбцов из БД в имена, ожидаемые get_product_info
-                return {
-                    "Магазин": row['store_number'],
-                    "Отдел": row['department'],
-                    "Артикул": row['article_code'],
-                    "Название": row['name'],
-                    "Гамма": row['gamma'],
-                    "Номер осн. пост.": row['supplier_code'],
-                    "Название осн. пост.": row['supplier_name'],
-                    "Топ в магазине": str(row['is_top_store'])
-                }
+                return _product_row_to_dict(row)
             
             # 2. Если не найден по точному ключу, ищем по артикулу в начале full_key
-            # Формируем шаблон поиска: full_key начинается с артикула
-            article_prefix = f"{article}%"
+            # Поиск по диапазону ключей вместо LIKE: регистронезависимый LIKE
+            # не использует индекс PRIMARY KEY и сканирует всю таблицу
             logging.info(f"Товар с full_key '{full_key_exact}' не найден, ищу по артикулу '{article}' в начале full_key...")
             
             cursor.execute("""
                 SELECT full_key, store_number, department, article_code, name, gamma, 
                        supplier_code, supplier_name, is_top_store
                 FROM articles 
-                WHERE full_key LIKE ?
+                WHERE full_key >= ? AND full_key < ?
                 ORDER BY full_key -- Сортируем для получения какого-либо результата
                 LIMIT 1
-            """, (article_prefix,))
+            """, (article, f"{article}\U0010ffff"))
             
             row = cursor.fetchone()
             
@@ -3383,16 +3680,7 @@ async def get_product_data_from_db(article: str, shop: str) -> Optional[Dict[str
                 found_shop = row['store_number']
                 logging.info(f"✅ Найден товар по артикулу в full_key: full_key='{found_key}', магазин={found_shop}, название={row['name']}")
                 # Отображаем имена столбцов из БД в имена, ожидаемые get_product_info
-                return {
-                    "Магазин": row['store_number'],
-                    "Отдел": row['department'],
-                    "Артикул": row['article_code'],
-                    "Название": row['name'],
-                    "Гамма": row['gamma'],
-                    "Номер осн. пост.": row['supplier_code'],
-                    "Название осн. пост.": row['supplier_name'],
-                    "Топ в магазине": str(row['is_top_store'])
-                }
+                return _product_row_to_dict(row)
             else:
                 logging.warning(f"❌ Товар с артикулом '{article}' не найден даже по артикулу в full_key")
                 
@@ -3409,6 +3697,9 @@ async def get_product_data_from_db(article: str, shop: str) -> Optional[Dict[str
 async def get_supplier_data_from_db(supplier_id: str, shop: str) -> Optional[Dict[str, Any]]:
     """
     Получение данных о поставщике и сроках поставки из SQLite.
+    Таблица поставщиков магазина загружается целиком при первом обращении
+    и хранится в supplier_cache как словарь {номер поставщика: запись parse_supplier_data}
+    (с дополнительным полем supplier_name).
 
     Args:
         supplier_id (str): Номер основного поставщика.
@@ -3422,47 +3713,59 @@ async def get_supplier_data_from_db(supplier_id: str, shop: str) -> Optional[Dic
     if not supplier_id:
         return None
 
+    supplier_map = supplier_cache.get(shop)
+    if supplier_map is None:
+        supplier_map = _load_supplier_map(shop)
+        if supplier_map is None:
+            return None
+        supplier_cache[shop] = supplier_map
+
+    supplier_data = supplier_map.get(supplier_id)
+    if not supplier_data:
+        logging.info(f"Поставщик {supplier_id} не найден в таблице 'Даты выходов заказов {shop}'")
+    return supplier_data
+
+
+def _load_supplier_map(shop: str) -> Optional[Dict[str, Dict[str, Any]]]:
+    """Загрузка всех поставщиков магазина из SQLite: {номер поставщика: разобранная запись}"""
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
             # Формируем имя таблицы поставщиков (как в Google Sheets)
             supplier_table_name = f"Даты выходов заказов {shop}"
 
-            # Определяем части SQL-запроса
-            select_clause = '''
+            cursor.execute(f'''
                 SELECT "Номер осн. пост.", "Название осн. пост.", "Срок доставки в магазин",
                        "День выхода заказа", "День выхода заказа 2", "День выхода заказа 3",
                        "Каникулы список", "Исключения список"
-            '''
-            from_clause = f'FROM "{supplier_table_name}"'
-            where_clause = 'WHERE "Номер осн. пост." = ?'
+                FROM "{supplier_table_name}"
+            ''')
 
-            # Собираем полный запрос
-            query = f"{select_clause} {from_clause} {where_clause}"
-            
-            cursor.execute(query, (supplier_id,))
-            
-            row = cursor.fetchone()
-            
-            if row:
-                # Преобразуем sqlite3.Row в словарь
-                return dict(row)
-            else:
-                logging.info(f"Поставщик {supplier_id} не найден в таблице '{supplier_table_name}'")
-                return None
+            # Записи разбираются один раз при загрузке: поиск товара получает готовые дни заказа и каникулы
+            supplier_map = {}
+            for row in cursor.fetchall():
+                record = dict(row)
+                supplier_id = str(record["Номер осн. пост."]).strip()
+                if supplier_id in supplier_map:
+                    continue
+                parsed = parse_supplier_data(record)
+                parsed['supplier_id'] = supplier_id
+                parsed['supplier_name'] = str(record["Название осн. пост."] or "Не указано").strip()
+                supplier_map[supplier_id] = parsed
+            logging.info(f"✅ Загружено {len(supplier_map)} поставщиков из таблицы '{supplier_table_name}'")
+            return supplier_map
                 
     except sqlite3.Error as e:
-        logging.error(f"Ошибка запроса к БД (get_supplier_data_from_db): {e}")
+        logging.error(f"Ошибка запроса к БД (_load_supplier_map): {e}")
         return None
     except Exception as e:
-        logging.error(f"Неожиданная ошибка в get_supplier_data_from_db: {e}")
+        logging.error(f"Неожиданная ошибка в _load_supplier_map: {e}")
         return None
         
 
 # ===================== MIDDLEWARES =====================
-@dp.update.middleware()
 async def service_mode_middleware(handler, event, data):
-    """Проверка сервисного режима"""
+    """Проверка сервисного режима (подключается только на время сервисного режима, см. set_service_mode)"""
     if SERVICE_MODE and (hasattr(event, 'message') or hasattr(event, 'callback_query')):
         user_id = (
             event.message.from_user.id 
@@ -3499,30 +3802,45 @@ async def service_mode_middleware(handler, event, data):
     # Если сервисный режим выключен или пользователь - админ, продолжаем
     return await handler(event, data)
 
-@dp.update.middleware()
+
+def set_service_mode(enable: bool) -> None:
+    """
+    Включение/выключение сервисного режима.
+    Middleware проверки подключается только пока режим включен: в обычной работе апдейты её не проходят.
+    """
+    global SERVICE_MODE
+    SERVICE_MODE = enable
+    registered = service_mode_middleware in dp.update.outer_middleware
+    if enable and not registered:
+        dp.update.outer_middleware.register(service_mode_middleware)
+    elif not enable and registered:
+        dp.update.outer_middleware.unregister(service_mode_middleware)
+
+
+set_service_mode(SERVICE_MODE)
+
 async def activity_tracker_middleware(handler, event, data):
     """Улучшенный трекинг активности пользователя с обработкой ошибок"""
-    try:
-        state = data.get('state')
-        if state:
-            # Получаем данные состояния
-            state_data = await state.get_data()
-            
-            # Обновляем активность ПОСЛЕ обработки сообщения
-            response = await handler(event, data)
-            
-            # Обновляем время активности
-            new_data = await state.get_data()
-            new_data['last_activity'] = datetime.now().isoformat()
-            await state.set_data(new_data)
-            
-            return response
-        
-        return await handler(event, data)
-        
-    except Exception as e:
-        logging.error(f"Ошибка в трекере активности: {str(e)}")
-        return await handler(event, data)
+    response = await handler(event, data)
+
+    # Обновляем время активности ПОСЛЕ обработки (ошибка трекинга не должна повторно вызывать обработчик).
+    # Вне сценариев (состояние не задано) отметка не нужна: очищать и сбрасывать нечего
+    state = data.get('state')
+    if state:
+        try:
+            if await state.get_state() is None:
+                return response
+            await state.update_data(last_activity=int(time.time()))
+        except Exception as e:
+            logging.error(f"Ошибка в трекере активности: {str(e)}")
+
+    return response
+
+
+# Активность пользователей бывает только в сообщениях и нажатиях кнопок:
+# остальные типы апдейтов через трекер не проходят
+dp.message.middleware(activity_tracker_middleware)
+dp.callback_query.middleware(activity_tracker_middleware)
 
 
 # ===================== АВТОМАТИЧЕСКАЯ ОЧИСТКА СОСТОЯНИЙ =====================
@@ -3530,7 +3848,7 @@ async def state_cleanup_task():
     """Фоновая задача для очистки устаревших состояний с логированием"""
     while True:
         try:
-            now = datetime.now()
+            now = time.time()
             cleared_count = 0
             
             if hasattr(dp.storage, 'storage'):
@@ -3542,14 +3860,14 @@ async def state_cleanup_task():
                         continue
                     
                     data = state_record.data
-                    last_activity_str = data.get('last_activity')
+                    # Время последней активности - Unix-время в секундах (ставит activity_tracker_middleware)
+                    last_activity = data.get('last_activity')
                     
-                    if not last_activity_str:
+                    if not last_activity:
                         continue
                     
                     try:
-                        last_activity = datetime.fromisoformat(last_activity_str)
-                        inactivity = (now - last_activity).total_seconds() / 60
+                        inactivity = (now - last_activity) / 60
                         
                         if inactivity > 30:
                             user_id = key.user_id
@@ -3589,9 +3907,6 @@ async def state_cleanup_task():
 @dp.message(Command("start"))
 async def start_handler(message: types.Message, state: FSMContext):
     """Обработчик команды /start"""
-    # Инициализируем активность в состоянии
-    await state.update_data(last_activity=datetime.now().isoformat())
-    
     user_data = await get_user_data(str(message.from_user.id))
     if user_data:
         await message.answer("ℹ️ Вы в главном меню:", 
@@ -3600,31 +3915,30 @@ async def start_handler(message: types.Message, state: FSMContext):
     
     await message.answer("👋 Добро пожаловать! Введите ваше имя:", 
                         reply_markup=types.ReplyKeyboardRemove())
-    await log_user_activity(message.from_user.id, "/start", "registration")
+    run_in_background(log_user_activity(message.from_user.id, "/start", "registration"))
     await state.set_state(Registration.name)
 
 # Регистрация пользователя
-@dp.message(Registration.name)
+@dp.message(Registration.name, F.text)
 async def process_name(message: types.Message, state: FSMContext):
-    await state.update_data(last_activity=datetime.now().isoformat(), name=message.text.strip())
+    await state.update_data(name=message.text.strip())
     await message.answer("📝 Введите вашу фамилию:")
     await state.set_state(Registration.surname)
 
-@dp.message(Registration.surname)
+@dp.message(Registration.surname, F.text)
 async def process_surname(message: types.Message, state: FSMContext):
-    await state.update_data(last_activity=datetime.now().isoformat(), surname=message.text.strip())
+    await state.update_data(surname=message.text.strip())
     await message.answer("💼 Введите вашу должность:")
     await state.set_state(Registration.position)
 
-@dp.message(Registration.position)
+@dp.message(Registration.position, F.text)
 async def process_position(message: types.Message, state: FSMContext):
-    await state.update_data(last_activity=datetime.now().isoformat(), position=message.text.strip())
+    await state.update_data(position=message.text.strip())
     await message.answer("🏪 Введите номер магазина (только цифры, без нулей):")
     await state.set_state(Registration.shop)
 
-@dp.message(Registration.shop)
+@dp.message(Registration.shop, F.text)
 async def process_shop(message: types.Message, state: FSMContext):
-    await state.update_data(last_activity=datetime.now().isoformat())
     shop = message.text.strip()
     
     if not shop.isdigit():
@@ -3632,20 +3946,23 @@ async def process_shop(message: types.Message, state: FSMContext):
         return
     
     data = await state.get_data()
-    users_sheet.append_row([
+    await run_in_thread(users_sheet.append_row, [
         str(message.from_user.id),
         data['name'],
         data['surname'],
         data['position'],
         shop,
-        datetime.now().strftime("%d.%m.%Y %H:%M")
+        now_minute_str()
     ])
-    cache.pop(f"user_{message.from_user.id}", None)  # Сброс кэша пользователя
-    
     try:
-        # Перезагружаем только кэш пользователей
-        users_records = users_sheet.get_all_records()
-        cache["users_data"] = pickle.dumps(users_records)
+        # Добавляем нового пользователя в кэш без повторной загрузки всего листа
+        cache_user_record({
+            "ID пользователя": str(message.from_user.id),
+            "Имя": data['name'],
+            "Фамилия": data['surname'],
+            "Должность": data['position'],
+            "Номер магазина": shop
+        })
         logging.info(f"✅ Кэш пользователей обновлен после регистрации пользователя {message.from_user.id}")
     except Exception as e:
         logging.error(f"Ошибка обновления кэша пользователей после регистрации {message.from_user.id}: {e}")
@@ -3666,10 +3983,7 @@ async def handle_back(message: types.Message, state: FSMContext):
 @dp.message(F.text.casefold() == "отмена")
 @dp.message(F.text == "❌ Отмена")
 async def cancel_handler(message: types.Message, state: FSMContext):
-    """Универсальный обработчик отмены с обновлением активности"""
-    # Обновляем активность перед обработкой
-    await state.update_data(last_activity=datetime.now().isoformat())
-    
+    """Универсальный обработчик отмены"""
     current_state = await state.get_state()
     if current_state:
         await state.clear()
@@ -3677,7 +3991,6 @@ async def cancel_handler(message: types.Message, state: FSMContext):
                             reply_markup=main_menu_keyboard(message.from_user.id))
 
 
-@dp.message(F.text == "📞 Обратная связь")
 async def handle_feedback_start(message: types.Message, state: FSMContext):
     """Начало процесса обратной связи."""
     await message.answer(
@@ -3695,12 +4008,7 @@ async def handle_feedback_message(message: types.Message, state: FSMContext):
     # Отправляем сообщение администраторам
     admin_notification = f"📢 <b>Новое сообщение обратной связи (анонимно)</b>\n\n{feedback_text}"
 
-    for admin_id in ADMINS:
-        try:
-            await bot.send_message(chat_id=admin_id, text=admin_notification, parse_mode='HTML')
-            logging.info(f"Сообщение обратной связи отправлено администратору {admin_id}")
-        except Exception as e:
-            logging.error(f"Не удалось отправить сообщение обратной связи администратору {admin_id}: {e}")
+    await notify_admins(admin_notification, parse_mode='HTML')
 
     # Уведомляем пользователя об успешной отправке
     await message.answer(
@@ -3756,8 +4064,8 @@ async def handle_ratings_csv_document(message: types.Message, state: FSMContext)
         logging.info(f"CSV файл рейтингов загружен: {temp_csv_path}")
 
         await message.answer("🔄 Обрабатываю файл рейтингов...")
-        from rating_module import process_csv_and_update_ratings
-        process_csv_and_update_ratings(temp_csv_path)
+        # pandas + запись в БД: в отдельном потоке, чтобы не останавливать обработку других апдейтов
+        await run_in_thread(process_csv_and_update_ratings, temp_csv_path)
         await message.answer("✅ Рейтинги успешно обновлены на основе загруженного файла.")
 
     except Exception as e:
@@ -3798,7 +4106,7 @@ async def cmd_reset_ratings(message: types.Message):
         await message.answer("❌ Ошибка: не удалось подключиться к базе данных рейтингов.")
         return
 
-    try:
+    def reset_tables():
         with engine.connect() as conn:
             trans = conn.begin()
             # Удаляем данные из weekly_data
@@ -3812,6 +4120,9 @@ async def cmd_reset_ratings(message: types.Message):
             conn.execute(text("DELETE FROM weeks;"))
             trans.commit()
             logging.info("Команда /reset_ratings: все данные из weekly_data и weeks удалены.")
+
+    try:
+        await run_in_thread(reset_tables)
         await message.answer("✅ Все данные рейтингов успешно удалены из базы данных.")
     except Exception as e:
         logging.error(f"Ошибка при удалении данных рейтингов: {e}")
@@ -3819,10 +4130,8 @@ async def cmd_reset_ratings(message: types.Message):
         
 
 # Заказ товара
-@dp.message(F.text == "🛒 Заказ под клиента")
 async def handle_client_order(message: types.Message, state: FSMContext):
     """Начало оформления заказа"""
-    await state.update_data(last_activity=datetime.now().isoformat())
     user_data = await get_user_data(str(message.from_user.id))
     
     if not user_data:
@@ -3837,7 +4146,7 @@ async def handle_client_order(message: types.Message, state: FSMContext):
     
     await message.answer("🔢 Введите артикул товара:", 
                          reply_markup=cancel_keyboard())
-    await log_user_activity(message.from_user.id, "Заказ под клиента", "order")
+    run_in_background(log_user_activity(message.from_user.id, "Заказ под клиента", "order"))
     await state.set_state(OrderStates.article_input)
 
 
@@ -3878,21 +4187,14 @@ async def process_article_input(message: types.Message, state: FSMContext):
         await state.set_state(OrderStates.waiting_for_quantities_list)
 
 
-@dp.message(OrderStates.shop_selection)
+@dp.message(OrderStates.shop_selection, F.text)
 async def process_shop_selection(message: types.Message, state: FSMContext):
     """Обработка выбора магазина из 3 вариантов"""
     user_data = await get_user_data(str(message.from_user.id))
     
-    # Словарь для сопоставления текста кнопки с номером магазина
-    shop_mapping = {
-        "🏪 Магазин 7": "7",
-        "🏪 Магазин 14": "14",
-        "🏪 Магазин 69": "69",
-        "🏪 Магазин 94": "94"
-    }
     
-    if message.text in shop_mapping:
-        selected_shop = shop_mapping[message.text]
+    if message.text in QUICK_SHOP_MAPPING:
+        selected_shop = QUICK_SHOP_MAPPING[message.text]
         await state.update_data(selected_shop=selected_shop)
         await continue_order_process(message, state)
     elif message.text == "❌ Отмена":
@@ -3920,22 +4222,15 @@ async def continue_order_process(message: types.Message, state: FSMContext):
         await state.clear()
         return
 
-    response = (
-        f"🏪 Магазин: {selected_shop}\n"
-        f"📦 Артикул: {product_info['Артикул']}\n"
-        f"🏷️ Название: {product_info['Название']}\n"
-        f"🏭 Поставщик: {product_info['Поставщик']}\n"
-        f"📅 Дата заказа: {product_info['Дата заказа']}\n"
-        f"🚚 Дата поставки: {product_info['Дата поставки']}\n"
-    )
+    response = ORDER_PRODUCT_TMPL.format(shop=selected_shop, p=product_info)
 
     # --- НОВОЕ: Информация о каникулах ---
     holidays = product_info.get('Каникулы', None)
     exceptions = product_info.get('Исключения', None)
 
     if holidays:
-        holiday_dates = holiday_ranges = format_holidays_ranges(holidays)
-        response += f"\n⚠️ Поставщик находится в каникулах: {holiday_dates}"
+        holiday_ranges = format_holidays_ranges(holidays)
+        response += f"\n⚠️ Поставщик находится в каникулах: {holiday_ranges}"
         if exceptions:
             exception_dates = ", ".join(d.strftime("%d.%m.%Y") for d in sorted(exceptions))
             response += f"\n✅ Но принимает заказы: {exception_dates}"
@@ -3972,7 +4267,7 @@ async def continue_order_process(message: types.Message, state: FSMContext):
         await state.set_state(OrderStates.quantity_input)
         
 
-@dp.message(OrderStates.quantity_input_for_top0)
+@dp.message(OrderStates.quantity_input_for_top0, F.text)
 async def process_quantity_input_for_top0(message: types.Message, state: FSMContext):
     """Обработка введенного количества для ТОП 0"""
     try:
@@ -3992,7 +4287,7 @@ async def process_quantity_input_for_top0(message: types.Message, state: FSMCont
     await state.set_state(OrderStates.reason_input_for_top0)
 
 
-@dp.message(OrderStates.reason_input_for_top0)
+@dp.message(OrderStates.reason_input_for_top0, F.text)
 async def process_reason_input_for_top0(message: types.Message, state: FSMContext):
     """Обработка причины заказа для ТОП 0"""
     reason = message.text.strip()
@@ -4003,19 +4298,25 @@ async def process_reason_input_for_top0(message: types.Message, state: FSMContex
     # Сохраняем причину
     await state.update_data(order_reason=reason)
 
-    # --- Получение информации о товаре ---
+    # --- Информация о товаре (сохранена в state в continue_order_process) ---
     data = await state.get_data()
     article = data['article']
     selected_shop = data['selected_shop']
-    product_info = await get_product_info(article, selected_shop) # Нужно снова получить, если не сохранено
-    if not product_info:
-        await message.answer("❌ Не удалось получить информацию о товаре. Попробуйте позже.", reply_markup=main_menu_keyboard(message.from_user.id))
-        await state.clear()
-        return
+    if not data.get('department'):
+        product_info = await get_product_info(article, selected_shop) # Нужно снова получить, если не сохранено
+        if not product_info:
+            await message.answer("❌ Не удалось получить информацию о товаре. Попробуйте позже.", reply_markup=main_menu_keyboard(message.from_user.id))
+            await state.clear()
+            return
+        data.update(
+            product_name=product_info['Название'],
+            supplier_name=product_info['Поставщик'],
+            department=product_info['Отдел']
+        )
 
-    product_name = product_info['Название']
-    product_supplier = product_info['Поставщик']
-    department = product_info['Отдел']
+    product_name = data['product_name']
+    product_supplier = data['supplier_name']
+    department = data['department']
     quantity = data['quantity'] # Уже проверен и сохранен
     reason = data['order_reason'] # Уже проверена и сохранена
 
@@ -4096,7 +4397,7 @@ async def process_reason_input_for_top0(message: types.Message, state: FSMContex
     return # Завершаем обработку, заказ приостановлен
 
 
-@dp.message(OrderStates.quantity_input)
+@dp.message(OrderStates.quantity_input, F.text)
 async def process_quantity_input(message: types.Message, state: FSMContext):
     """Обработка введенного количества (только для НЕ ТОП 0)"""
     try:
@@ -4116,32 +4417,22 @@ async def process_quantity_input(message: types.Message, state: FSMContext):
     await state.set_state(OrderStates.order_reason_input)
     
 
-@dp.message(OrderStates.order_reason_input)
+@dp.message(OrderStates.order_reason_input, F.text)
 async def process_order_reason(message: types.Message, state: FSMContext):
     """Обработка причины заказа (только для НЕ ТОП 0 или после одобрения)"""
     reason = message.text.strip()
-    await state.update_data(order_reason=reason)
+    # Одно чтение состояния + одна запись (update_data сам повторно читает данные)
     data = await state.get_data()
-    selected_shop = data.get('selected_shop')
+    await state.set_data({**data, 'order_reason': reason})
     
     # Формируем сообщение подтверждения (без логики ТОП 0)
-    response = (
-        "🔎 Проверьте данные заказа:\n"
-        f"🏪 Магазин: {selected_shop}\n"
-        f"📦 Артикул: {data['article']}\n"
-        f"🏷️ Название: {data['product_name']}\n"
-        f"🏭 Поставщик: {data['supplier_name']}\n" # Используем supplier_name
-        f"📅 Дата заказа: {data['order_date']}\n"
-        f"🚚 Дата поставки: {data['delivery_date']}\n"
-        f"🔢 Кол-во: {data['quantity']}\n"
-        f"📝 Причина: {reason}\n"
-    )
+    response = ORDER_CONFIRM_TMPL.format_map(TemplateData(data, order_reason=reason))
     
     holidays = data.get('holidays', [])  
     exceptions = data.get('exceptions', [])
 
     if holidays:
-        holiday_dates = holiday_ranges = format_holidays_ranges(holidays)
+        holiday_dates = format_holidays_ranges(holidays)
         response += f"\n⚠️ Поставщик находится в каникулах: {holiday_dates}"
         if exceptions:
             exception_dates = ", ".join(d.strftime("%d.%m.%Y") for d in sorted(exceptions))
@@ -4157,7 +4448,6 @@ async def final_confirmation(message: types.Message, state: FSMContext):
     """Подтверждение заказа с добавлением в очередь."""
     
     # --- Получаем данные заказа ---
-    await state.update_data(last_activity=datetime.now().isoformat())
     data = await state.get_data()
     
     # Проверка обязательных полей
@@ -4186,14 +4476,9 @@ async def final_confirmation(message: types.Message, state: FSMContext):
         critical_error_msg = f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось добавить заказ пользователя {user_id} в очередь БД!"
         logging.critical(critical_error_msg)
         # Отправляем уведомление админам
-        for admin_id in ADMINS:
-            try:
-                await bot.send_message(
-                    admin_id, 
-                    f"🚨 {critical_error_msg}\nАртикул: {data.get('article', 'N/A')}, Магазин: {data.get('selected_shop', 'N/A')}"
-                )
-            except Exception as notify_err:
-                logging.error(f"Не удалось уведомить админа {admin_id}: {notify_err}")
+        await notify_admins(
+            f"🚨 {critical_error_msg}\nАртикул: {data.get('article', 'N/A')}, Магазин: {data.get('selected_shop', 'N/A')}"
+        )
     else:
         logging.info(f"Заказ пользователя {user_id} успешно поставлен в очередь.")
     
@@ -4238,9 +4523,6 @@ async def initiate_order_from_info(message: types.Message, state: FSMContext):
     user_position = user_data.get('position', 'Не указана')
     # --------------------------------------------------------
 
-    # Обновляем last_activity
-    await state.update_data(last_activity=datetime.now().isoformat())
-
     # Сохраняем артикул И информацию о пользователе в состоянии для следующего шага
     await state.update_data(
         article=article,
@@ -4290,12 +4572,10 @@ async def unexpected_input_waiting_action(message: types.Message):
 
 
 # Запрос информации о товаре
-@dp.message(F.text == "📋 Запрос информации")
 async def handle_info_request(message: types.Message, state: FSMContext):
     """Обработчик запроса информации с защитой от потери данных"""
     try:
-        await state.update_data(last_activity=datetime.now().isoformat())
-        await log_user_activity(message.from_user.id, "Запрос информации", "info")
+        run_in_background(log_user_activity(message.from_user.id, "Запрос информации", "info"))
         
         # Получаем данные пользователя
         user_data = await get_user_data(str(message.from_user.id))
@@ -4310,10 +4590,7 @@ async def handle_info_request(message: types.Message, state: FSMContext):
             return
         
         # Сохраняем магазин в состоянии
-        await state.set_data({
-            'shop': shop,
-            'last_activity': datetime.now().isoformat()
-        })
+        await state.set_data({'shop': shop})
         
         await message.answer("🔢 Введите артикул товара:", reply_markup=cancel_keyboard())
         await state.set_state(InfoRequest.article_input)
@@ -4324,6 +4601,15 @@ async def handle_info_request(message: types.Message, state: FSMContext):
         await state.clear()
 
 
+# Маршруты кнопок главного меню (используются в route_main_menu)
+MAIN_MENU_ROUTES = {
+    "📋 Запрос информации": handle_info_request,
+    "🛒 Заказ под клиента": handle_client_order,
+    "🖼️ Экспо": handle_expo_start,
+    "📞 Обратная связь": handle_feedback_start,
+}
+
+
 @dp.message(InfoRequest.article_input)
 async def process_info_request(message: types.Message, state: FSMContext):
     """Обработка запроса информации о товаре с дополнительной защитой"""
@@ -4396,16 +4682,7 @@ async def process_info_request(message: types.Message, state: FSMContext):
             top_in_shop=product_info.get('Топ в магазине', '0') # Убедитесь, что ключ совпадает
         )
         # Формирование ответа
-        response = (
-            f"🔍 Информация о товаре:\n"
-            f"🏪 Магазин: {shop}\n"
-            f"📦 Артикул: {product_info['Артикул']}\n"
-            f"🏷️ Название: {product_info['Название']}\n"
-            f"🔢 Отдел: {product_info['Отдел']}\n"
-            f"📅 Ближайшая дата заказа: {product_info['Дата заказа']}\n"
-            f"🚚 Ожидаемая дата поставки: {product_info['Дата поставки']}\n"
-            f"🏭 Поставщик: {product_info['Поставщик']}" 
-        )
+        response = INFO_PRODUCT_TMPL.format(shop=shop, p=product_info)
         
         # Добавляем предупреждение для ТОП 0
         top_status = product_info.get('Топ в магазине', '0')
@@ -4425,14 +4702,8 @@ async def process_info_request(message: types.Message, state: FSMContext):
                 exception_dates = ", ".join(d.strftime("%d.%m.%Y") for d in sorted(exceptions))
                 response += f"\n✅ Но принимает заказы: {exception_dates}"
 
-        builder = ReplyKeyboardBuilder()
-        builder.button(text="🛒 Заказать этот товар")
-        builder.button(text="🔄 Повторить ввод артикула")
-        builder.button(text="🏠 В главное меню")
-        action_kb = builder.as_markup(resize_keyboard=True)
-
         # Отправляем сообщение с информацией и клавиатурой
-        await message.answer(response, reply_markup=action_kb)
+        await message.answer(response, reply_markup=INFO_ACTION_KB)
 
         # Устанавливаем новое состояние, ожидая действия пользователя
         await state.set_state(InfoRequest.waiting_for_action)
@@ -4447,8 +4718,20 @@ async def process_info_request(message: types.Message, state: FSMContext):
 
 
 ##=============================ОБРАБОТЧИКИ АДМИН ПАНЕЛИ====================================
-@dp.message(F.text == "🛠 Админ-панель")
-async def handle_admin_panel(message: types.Message):
+ADMIN_PANEL_ROUTE_TEXTS = frozenset({
+    "🛠 Админ-панель", "📊 Статистика", "📊 Дамп памяти", "📢 Рассылка",
+    "🔄 Обновить кэш", "🔧 Сервисный режим", "🟢 Включить сервисный режим", "🔴 Выключить сервисный режим",
+})
+
+
+# Только вне сценариев: текст в состоянии FSM (например, текст рассылки) забирают обработчики состояний
+@dp.message(StateFilter(None), F.text.in_(ADMIN_PANEL_ROUTE_TEXTS))
+async def route_admin_panel(message: types.Message, state: FSMContext):
+    """Единая точка входа для кнопок админ-панели: выбор обработчика по словарю"""
+    await ADMIN_PANEL_ROUTES[message.text](message, state)
+
+
+async def handle_admin_panel(message: types.Message, state: FSMContext):
     """Панель администратора"""
     if message.from_user.id not in ADMINS:
         await message.answer("⛔ У вас нет прав доступа")
@@ -4458,8 +4741,7 @@ async def handle_admin_panel(message: types.Message):
                         reply_markup=admin_panel_keyboard())
 
 
-@dp.message(F.text == "📊 Статистика")
-async def handle_admin_stats(message: types.Message):
+async def handle_admin_stats(message: types.Message, state: FSMContext):
     """Статистика бота"""
     if message.from_user.id not in ADMINS:
         return
@@ -4470,11 +4752,12 @@ async def handle_admin_stats(message: types.Message):
         users_count = len(users_data) if users_data else 0
         
         # ПРЯМОЕ ОБРАЩЕНИЕ К GOOGLE SHEETS ДЛЯ СТАТИСТИКИ
-        stats_sheet = main_spreadsheet.worksheet(STATSS_SHEET_NAME)
-        stats_records = stats_sheet.get_all_records()
+        stats_sheet = await run_in_thread(get_worksheet, main_spreadsheet, STATSS_SHEET_NAME)
+        # Читаем только столбец "Тип события" вместо всего листа
+        event_types = (await run_sheets_read(stats_sheet.col_values, STATS_EVENT_TYPE_COL))[1:]
         
         # Считаем количество заказов
-        orders_count = sum(1 for r in stats_records if r.get('Тип события') == 'order')
+        orders_count = event_types.count('order')
         
         # Получаем системные метрики
         cpu_usage = psutil.cpu_percent()
@@ -4484,7 +4767,7 @@ async def handle_admin_stats(message: types.Message):
             f"📊 Статистика бота:\n\n"
             f"• Пользователей: {users_count}\n"
             f"• Заказов оформлено: {orders_count}\n"
-            f"• Логов действий: {len(stats_records)}\n\n"
+            f"• Логов действий: {len(event_types)}\n\n"
             f"⚙️ Состояние сервера:\n"
             f"• Загрузка CPU: {cpu_usage}%\n"
             f"• Использование RAM: {memory_usage}%\n"
@@ -4499,8 +4782,7 @@ async def handle_admin_stats(message: types.Message):
 
 
 
-@dp.message(F.text == "📊 Дамп памяти")
-async def handle_memory_dump(message: types.Message):
+async def handle_memory_dump(message: types.Message, state: FSMContext):
     """Генерация дампа памяти для анализа (текстовый вариант)"""
     if message.from_user.id not in ADMINS:
         return
@@ -4553,7 +4835,6 @@ async def handle_memory_dump(message: types.Message):
 
 ##===============РАССЫЛКА=================
 
-@dp.message(F.text == "📢 Рассылка")
 async def handle_broadcast_menu(message: types.Message, state: FSMContext):
     """Начало процесса рассылки"""
     if message.from_user.id not in ADMINS:
@@ -4603,7 +4884,7 @@ async def process_broadcast_message(message: types.Message, state: FSMContext):
     )
     await state.set_state(AdminBroadcast.target_selection)
 
-@dp.message(AdminBroadcast.target_selection)
+@dp.message(AdminBroadcast.target_selection, F.text)
 async def handle_target_selection(message: types.Message, state: FSMContext):
     """Обработка выбора целевой аудитории"""
     if message.text == "Всем пользователям":
@@ -4621,7 +4902,7 @@ async def handle_target_selection(message: types.Message, state: FSMContext):
         await message.answer("❌ Неверный выбор. Пожалуйста, используйте кнопки.", 
                             reply_markup=broadcast_target_keyboard())
 
-@dp.message(AdminBroadcast.manual_ids)
+@dp.message(AdminBroadcast.manual_ids, F.text)
 async def process_manual_ids(message: types.Message, state: FSMContext):
     """Обработка ручного ввода ID"""
     user_ids = [id.strip() for id in message.text.split(",") if id.strip().isdigit()]
@@ -4645,8 +4926,8 @@ async def confirm_broadcast(message: types.Message, state: FSMContext):
     
     # Получаем список всех пользователей для рассылки
     if target == "all":
-        users_data = pickle.loads(cache.get("users_data", b"[]"))
-        user_ids = [str(user['ID пользователя']) for user in users_data if user.get('ID пользователя')]
+        users_by_id = await get_users_index()
+        user_ids = list(users_by_id) if users_by_id is not None else []
     elif target == "manual":
         # Уже есть user_ids
         pass
@@ -4657,21 +4938,18 @@ async def confirm_broadcast(message: types.Message, state: FSMContext):
         return
     
     # Записываем в логи
-    try:
-        logs_sheet.append_row([
-            datetime.now().strftime("%d.%m.%Y %H:%M"),
-            message.from_user.id,
-            "BROADCAST",
-            f"Type: {content['type']}, Users: {len(user_ids)}"
-        ])
-    except Exception as e:
-        logging.error(f"Ошибка логирования рассылки: {str(e)}")
+    enqueue_log_row([
+        now_minute_str(),
+        message.from_user.id,
+        "BROADCAST",
+        f"Type: {content['type']}, Users: {len(user_ids)}"
+    ])
     
     await message.answer(f"🔄 Начинаю рассылку для {len(user_ids)} пользователей...", 
                         reply_markup=admin_panel_keyboard())
     
     # Запускаем асинхронную рассылку
-    asyncio.create_task(send_broadcast(content, user_ids))
+    run_in_background(send_broadcast(content, user_ids))
     
     await state.clear()
 
@@ -4681,35 +4959,34 @@ async def send_broadcast(content: dict, user_ids: list):
     failed = 0
     errors = []
     
-    for user_id in user_ids:
+    async def send_one(user_id: str) -> None:
+        nonlocal success, failed
         try:
-            if not user_id.strip():
-                continue
-                
             if content['type'] == 'text':
-                await bot.send_message(int(user_id), content['text'])
+                await send_rate_limited(bot.send_message, int(user_id), content['text'])
             elif content['type'] == 'photo':
-                await bot.send_photo(
+                await send_rate_limited(
+                    bot.send_photo,
                     int(user_id),
                     photo=content['media'],
                     caption=content.get('caption', '')
                 )
             elif content['type'] == 'document':
-                await bot.send_document(
+                await send_rate_limited(
+                    bot.send_document,
                     int(user_id),
                     document=content['media'],
                     caption=content.get('caption', '')
                 )
-            
             success += 1
-            await asyncio.sleep(0.1)  # Защита от ограничений
         except TelegramForbiddenError:
             failed += 1  # Пользователь заблокировал бота
         except Exception as e:
             failed += 1
+            errors.append(type(e).__name__)
             logging.error(f"Ошибка рассылки для {user_id}: {str(e)}")
-            if not isinstance(e, (TelegramBadRequest, TimeoutError)):
-                raise
+    
+    await asyncio.gather(*(send_one(user_id) for user_id in user_ids if str(user_id).strip()))
     
     # Отправляем отчет администратору
     report = (
@@ -4731,14 +5008,16 @@ async def send_broadcast(content: dict, user_ids: list):
 
 ##===============ОБРАБОТЧИКИ=================
 
-@dp.message(F.text == "🔄 Обновить кэш")
-async def handle_cache_refresh(message: types.Message):
+async def handle_cache_refresh(message: types.Message, state: FSMContext):
     """Обновление кэша"""
     if message.from_user.id not in ADMINS:
         return
     
     try:
         cache.clear()
+        product_cache.clear()
+        supplier_cache.clear()
+        worksheets_cache.clear()
         await preload_cache()
         await message.answer("✅ Кэш успешно обновлен!", 
                             reply_markup=admin_panel_keyboard())
@@ -4746,8 +5025,7 @@ async def handle_cache_refresh(message: types.Message):
         await message.answer(f"❌ Ошибка обновления кэша: {str(e)}", 
                             reply_markup=admin_panel_keyboard())
 
-@dp.message(F.text == "🔧 Сервисный режим")
-async def handle_service_mode_menu(message: types.Message):
+async def handle_service_mode_menu(message: types.Message, state: FSMContext):
     """Управление сервисным режимом"""
     if message.from_user.id not in ADMINS:
         return
@@ -4758,29 +5036,38 @@ async def handle_service_mode_menu(message: types.Message):
         reply_markup=service_mode_keyboard()
     )
 
-@dp.message(F.text == "🟢 Включить сервисный режим")
-async def enable_service_mode(message: types.Message):
+async def enable_service_mode(message: types.Message, state: FSMContext):
     """Включение сервисного режима"""
     if message.from_user.id not in ADMINS:
         return
     
-    global SERVICE_MODE
-    SERVICE_MODE = True
+    set_service_mode(True)
     await message.answer("✅ Сервисный режим включен", 
                         reply_markup=admin_panel_keyboard())
 
-@dp.message(F.text == "🔴 Выключить сервисный режим")
-async def disable_service_mode(message: types.Message):
+async def disable_service_mode(message: types.Message, state: FSMContext):
     """Выключение сервисного режима"""
     if message.from_user.id not in ADMINS:
         return
     
-    global SERVICE_MODE
-    SERVICE_MODE = False
+    set_service_mode(False)
     await message.answer("✅ Сервисный режим выключен", 
                         reply_markup=admin_panel_keyboard())
 
 
+# Маршруты кнопок админ-панели (используются в route_admin_panel)
+ADMIN_PANEL_ROUTES = {
+    "🛠 Админ-панель": handle_admin_panel,
+    "📊 Статистика": handle_admin_stats,
+    "📊 Дамп памяти": handle_memory_dump,
+    "📢 Рассылка": handle_broadcast_menu,
+    "🔄 Обновить кэш": handle_cache_refresh,
+    "🔧 Сервисный режим": handle_service_mode_menu,
+    "🟢 Включить сервисный режим": enable_service_mode,
+    "🔴 Выключить сервисный режим": disable_service_mode,
+}
+
+
 # ===================== ЗАПУСК ПРИЛОЖЕНИЯ =====================
 async def scheduled_cache_update():
     """Плановое обновление кэша"""
@@ -4798,6 +5085,8 @@ async def startup():
     logging.info("🟢 Бот запускается...")
     try:  
         asyncio.create_task(memory_monitor())
+        asyncio.create_task(log_flusher())
+        asyncio.create_task(log_flusher(STATS_QUEUE, flush_stats_rows))
         await preload_cache()
         asyncio.create_task(scheduled_cache_update())
         asyncio.create_task(state_cleanup_task())
@@ -4825,6 +5114,8 @@ async def startup():
 async def shutdown():
     """Завершение работы"""
     try:
+        await drain_log_queue()
+        await drain_log_queue(STATS_QUEUE, flush_stats_rows)
         await bot.session.close()
         await dp.storage.close()
         logging.info("✅ Ресурсы успешно освобождены")
@@ -4834,11 +5125,17 @@ async def shutdown():
 async def main():
     """Главная функция запуска"""
     try:
+        # Пул по умолчанию (min(32, CPU + 4)) на малых серверах - 5 потоков: параллельные
+        # запросы к Sheets ждали бы друг друга
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=BLOCKING_IO_WORKERS))
         await startup()
         initialize_approval_requests_table()
         initialize_order_queue_table()
+        # Снимаем webhook (если был установлен) и отбрасываем накопившиеся апдейты:
+        # в aiogram 3 параметра skip_updates у start_polling нет
+        await bot.delete_webhook(drop_pending_updates=True)
         logging.info("✅ Бот запущен в режиме поллинга")
-        await dp.start_polling(bot, skip_updates=True)
+        await dp.start_polling(bot)
     except KeyboardInterrupt:
         logging.info("🛑 Бот остановлен пользователем")
     except Exception as e:
@@ -4853,15 +5150,25 @@ async def main():
                 )
             except Exception:
                 pass
+        # Пробрасываем дальше: процесс должен завершиться с ненулевым кодом для перезапуска супервизором
+        raise
     finally:
         await shutdown()
 
 if __name__ == "__main__":
+    # uvloop (если установлен, недоступен на Windows) - более быстрый цикл событий для сетевого ввода-вывода
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logging.info("⚡ Используется цикл событий uvloop")
+    except ImportError:
+        pass
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
         logging.info("🛑 Бот остановлен пользователем")
     except Exception as e:
         logging.critical(f"🚨 Критическая ошибка: {str(e)}")
+        raise SystemExit(1)
     finally:
         asyncio.run(shutdown())
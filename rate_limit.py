@@ -0,0 +1,42 @@
+# rate_limit.py
+
+import asyncio
+import time
+
+
+class AsyncTokenBucket:
+    """Ограничитель частоты (token bucket): в среднем rate операций в секунду, всплеск до capacity.
+    clock и sleep подменяются в тестах"""
+
+    def __init__(self, rate: float, capacity: float, clock=time.monotonic, sleep=asyncio.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self.tokens = capacity
+        self.updated = clock()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """Остановка выдачи токенов на seconds секунд (например, по retry_after от Telegram)"""
+        self.paused_until = max(self.paused_until, self._clock() + seconds)
+        # Запас токенов сгорает, а пополнение идёт с конца паузы: после неё отправки
+        # возобновляются с обычной скоростью, без всплеска
+        self.tokens = 0
+        self.updated = self.paused_until
+
+    async def acquire(self) -> None:
+        # Очередь ожидающих - через блокировку: токены выдаются по одному в порядке запросов
+        async with self._lock:
+            while True:
+                now = self._clock()
+                if now < self.paused_until:
+                    await self._sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await self._sleep((1 - self.tokens) / self.rate)
@@ -0,0 +1,121 @@
+# supplier_schedule.py
+
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+
+
+def _as_int(value) -> Optional[int]:
+    """
+    Число из значения поставщика. Из SQLite дни уже приходят как INTEGER
+    (нормализованы при импорте) - их берем как есть, без str().strip().
+    """
+    if isinstance(value, int):
+        return value
+    value = str(value).strip()
+    return int(value) if value.isdigit() else None
+
+
+def parse_supplier_data(record: dict) -> Dict[str, Any]:
+    """Парсинг данных поставщика"""
+    order_days = []
+    for key in ['День выхода заказа', 'День выхода заказа 2', 'День выхода заказа 3']:
+        value = _as_int(record.get(key, ''))
+        # Пустой день при импорте сохраняется как 0: в график попадают только дни недели 1-7 (isoweekday)
+        if value is not None and 1 <= value <= 7:
+            order_days.append(value)
+    
+    delivery_days = _as_int(record.get('Срок доставки в магазин', 0))
+
+    # --- Парсим каникулы ---
+    holidays_str = str(record.get('Каникулы список', '')).strip()
+    holidays = set()
+    if holidays_str:
+        for date_str in holidays_str.split(','):
+            date_str = date_str.strip()
+            if date_str:
+                try:
+                    date_obj = datetime.strptime(date_str, "%d.%m.%Y").date()
+                    holidays.add(date_obj)
+                except ValueError:
+                    logging.warning(f"⚠️ Некорректный формат даты каникул: {date_str}")
+
+    # --- Парсим исключения (заказы внутри каникул) ---
+    exceptions_str = str(record.get('Исключения список', '')).strip()  # <-- НОВОЕ ПОЛЕ
+    exceptions = set()
+    if exceptions_str:
+        for date_str in exceptions_str.split(','):
+            date_str = date_str.strip()
+            if date_str:
+                try:
+                    date_obj = datetime.strptime(date_str, "%d.%m.%Y").date()
+                    exceptions.add(date_obj)
+                except ValueError:
+                    logging.warning(f"⚠️ Некорректный формат даты исключения: {date_str}")
+
+    return {
+        'supplier_id': str(record.get('Номер осн. пост.', '')),
+        'order_days': sorted(list(set(order_days))),
+        'delivery_days': delivery_days or 0,
+        'holidays': holidays,
+        'exceptions': exceptions  # <-- Добавляем исключения
+    }
+    
+
+def calculate_delivery_date(supplier_data: dict) -> Tuple[str, str]:
+    today = datetime.now().date()
+    current_weekday = today.isoweekday()
+
+    order_days = supplier_data['order_days']
+    holidays = supplier_data.get('holidays', set())
+    exceptions = supplier_data.get('exceptions', set())
+
+    # Без каникул и исключений даты считаются напрямую по дням недели
+    if order_days and not holidays and not exceptions:
+        order_date = today + timedelta(days=min((day - current_weekday) % 7 for day in order_days))
+        delivery_date = order_date + timedelta(days=supplier_data['delivery_days'])
+        return (
+            order_date.strftime("%d.%m.%Y"),
+            delivery_date.strftime("%d.%m.%Y")
+        )
+
+    # --- 1. Найти ближайший день заказа ---
+    candidate_date = today
+    while True:
+        # Проверяем, является ли день заказа по графику
+        candidate_weekday = candidate_date.isoweekday()
+        is_scheduled_order_day = candidate_weekday in order_days
+
+        # Проверяем, является ли день исключением
+        is_exception = candidate_date in exceptions
+
+        # Если это исключение — можно заказать, даже если не день заказа
+        if is_exception:
+            order_date = candidate_date
+            break
+
+        # Если это день заказа и не каникулы — можно заказать
+        if is_scheduled_order_day and candidate_date not in holidays:
+            order_date = candidate_date
+            break
+
+        # Иначе — идём дальше
+        candidate_date += timedelta(days=1)
+
+    # --- 2. Рассчитать дату поставки ---
+    delivery_date = order_date
+    days_added = 0
+    while days_added < supplier_data['delivery_days']:
+        next_day = delivery_date + timedelta(days=1)
+        # Если следующий день — каникулы, но не исключение — пропускаем
+        if next_day in holidays and next_day not in exceptions:
+            delivery_date = next_day
+            continue
+        # Иначе — засчитываем день
+        delivery_date = next_day
+        days_added += 1
+
+    return (
+        order_date.strftime("%d.%m.%Y"),
+        delivery_date.strftime("%d.%m.%Y")
+    )
@@ -0,0 +1,33 @@
+from datetime import date
+from itertools import combinations
+
+from supplier_schedule import parse_supplier_data, calculate_delivery_date
+
+# Каникулы в прошлом не влияют на даты, но переводят расчет на пошаговый обход
+PAST_HOLIDAYS = {date(2000, 1, 1)}
+
+
+def supplier_record(days, delivery_days=2):
+    """Строка поставщика как после импорта: пустые дни выхода заказа сохранены как 0"""
+    days = list(days) + [0] * (3 - len(days))
+    return {
+        'Номер осн. пост.': '100',
+        'День выхода заказа': days[0],
+        'День выхода заказа 2': days[1],
+        'День выхода заказа 3': days[2],
+        'Срок доставки в магазин': delivery_days,
+    }
+
+
+def test_empty_order_days_are_dropped():
+    supplier_data = parse_supplier_data(supplier_record([3]))
+    assert supplier_data['order_days'] == [3]
+
+
+def test_fast_path_matches_day_by_day_walk():
+    for count in (1, 2, 3):
+        for days in combinations(range(1, 8), count):
+            supplier_data = parse_supplier_data(supplier_record(days))
+            fast = calculate_delivery_date(supplier_data)
+            slow = calculate_delivery_date({**supplier_data, 'holidays': PAST_HOLIDAYS})
+            assert fast == slow, days
@@ -0,0 +1,56 @@
+import asyncio
+from fractions import Fraction
+
+from rate_limit import AsyncTokenBucket
+
+
+class FakeClock:
+    """Часы для бакета: sleep сдвигает время мгновенно, тесты не зависят от реальных задержек.
+    Время хранится в Fraction, чтобы расчёт токенов был точным"""
+
+    def __init__(self):
+        self.now = Fraction(0)
+
+    def monotonic(self) -> Fraction:
+        return self.now
+
+    async def sleep(self, seconds) -> None:
+        self.now += seconds
+
+
+def make_bucket(clock, rate=10, capacity=10):
+    return AsyncTokenBucket(rate=rate, capacity=capacity, clock=clock.monotonic, sleep=clock.sleep)
+
+
+def acquire_times(bucket, clock, count):
+    async def run():
+        times = []
+        for _ in range(count):
+            await bucket.acquire()
+            times.append(clock.now)
+        return times
+    return asyncio.run(run())
+
+
+def test_full_bucket_allows_burst_up_to_capacity():
+    clock = FakeClock()
+    bucket = make_bucket(clock)
+    times = acquire_times(bucket, clock, 11)
+    assert times[:10] == [0] * 10
+    assert times[10] == Fraction(1, 10)
+
+
+def test_sends_after_pause_are_throttled():
+    clock = FakeClock()
+    bucket = make_bucket(clock)
+    bucket.pause(2)
+    # После паузы каждый токен копится заново (0.1 с при rate=10), запаса на всплеск нет
+    assert acquire_times(bucket, clock, 3) == [Fraction(21, 10), Fraction(22, 10), Fraction(23, 10)]
+
+
+def test_idle_after_pause_refills_only_from_pause_end():
+    clock = FakeClock()
+    bucket = make_bucket(clock)
+    bucket.pause(2)
+    clock.now = Fraction(205, 100)
+    assert acquire_times(bucket, clock, 3) == [Fraction(21, 10), Fraction(22, 10), Fraction(23, 10)]